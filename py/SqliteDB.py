@@ -1,6 +1,8 @@
 '''
 Some conveniences for working with SQLite dababases
 '''
+import time
+from collections import defaultdict
 from sqlite3 import dbapi2 as sqlite
 from sqlite3.dbapi2 import DataError, DatabaseError, Error, IntegrityError, \
                              InterfaceError, InternalError, NotSupportedError, \
@@ -16,13 +18,15 @@ class UnwrapCursor(sqlite.Cursor):
         backend for both fetchvalues and fetchvalue
         '''
         assert len(item) == 1, 'method only handles singlet results'
+
+        if isinstance(item, dict):      # cheaper than trying item[0] and failing
+            for value in item.values():
+                return value
+
         try:
-            return item[0]                        # tuple or similar?
-        except KeyError:
-            try:                                  # assume dict
-                return list(item.values())[0]
-            except:
-                raise TypeError("method only handles lists/tuples or mappings")
+            return item[0]                        # tuple, sqlite3.Row or similar?
+        except (KeyError, TypeError):
+            raise TypeError("method only handles lists/tuples or mappings")
 
 
     def fetchvalues(self):
@@ -44,17 +48,29 @@ class SqliteDB(object):
     cursor_class = UnwrapCursor
 
     pragmas = ["foreign_keys=on"]                     # required to make cascading deletes work
-    connection_args = {'isolation_level':'immediate'} # None for autocommit,
+    connection_args = {'isolation_level':'immediate', # None for autocommit,
                                                       # 'deferred', 'exclusive'
+                       'cached_statements': 512}      # prepared statements kept by the connection
 
-    def __init__(self, db_path=None):
+    # row_dicts can be True for dicts, False for tuples, or ROWS for sqlite3.Row
+    # objects. Rows can be indexed by column name like dicts, but they are made
+    # in C, which makes them much cheaper on queries that return many rows.
+    ROWS = 'rows'
 
+    def __init__(self, db_path=None, pragmas=None):
+        '''
+        pragmas, e.g. ['journal_mode=wal'], are applied after the class
+        ones whenever a connection is opened.
+        '''
         if db_path is not None:
             self.db_path = db_path
+        if pragmas is not None:
+            self.pragmas = self.pragmas + list(pragmas)
         self._db = None
         self._columns = {}
-        self._row_dicts = True
-        self._connection = self._cursor = None
+        self._connection = None
+        self._cursors = {}      # one cursor for each kind of row
+        self.timings = None     # see enable_timing
 
 
     def _dict_factory(self, cursor, row):
@@ -71,9 +87,10 @@ class SqliteDB(object):
         return d
 
 
-    def get_connection(self, row_dicts=True):
+    def get_connection(self):
         '''
-        create and cache one connection instance.
+        create and cache one connection instance. The connection itself returns
+        tuples; the cursors from get_cursor set their own row factories.
         '''
         conn = self._connection
 
@@ -87,24 +104,28 @@ class SqliteDB(object):
                 for pragma in self.pragmas:
                     cursor.execute('pragma ' + pragma)
 
-        if row_dicts:
-            rf = self._dict_factory
-        else:
-            rf = None
-        conn.row_factory = rf
-
-        self._row_dicts = row_dicts  # flag state of current connectoin
-
         return conn
 
 
     def get_cursor(self, row_dicts=True, reuse=True):
         '''
-        get hold of a cursor - we reuse by default.
+        get hold of a cursor - we reuse one per kind of row by default, so that
+        switching between dicts and tuples doesn't make new cursors all the time.
         '''
-        if not reuse or row_dicts != self._row_dicts or self._cursor is None:
-            self._cursor = self.get_connection(row_dicts).cursor(self.cursor_class)
-        return self._cursor
+        cursor = self._cursors.get(row_dicts, None) if reuse else None
+
+        if cursor is None:
+            cursor = self.get_connection().cursor(self.cursor_class)
+
+            if row_dicts == self.ROWS:
+                cursor.row_factory = sqlite.Row
+            elif row_dicts:
+                cursor.row_factory = self._dict_factory
+
+            if reuse:
+                self._cursors[row_dicts] = cursor
+
+        return cursor
 
 
     def execute(self, stmt, values=None, row_dicts=True):
@@ -114,14 +135,43 @@ class SqliteDB(object):
         '''
         c = self.get_cursor(row_dicts)
 
+        if self.timings is not None:
+            start = time.perf_counter()
+
         if values is not None:
             c.execute(stmt, values)
         else:
             c.execute(stmt)
 
+        if self.timings is not None:
+            entry = self.timings[' '.join(stmt.split())]
+            entry[0] += 1
+            entry[1] += time.perf_counter() - start
+
         return c
 
 
+    def enable_timing(self, enable=True):
+        '''
+        keep count of how often each statement runs and how long execute takes
+        for it. For queries, execute only covers the work up to the first row;
+        the rest happens while fetching.
+        '''
+        self.timings = defaultdict(lambda: [0, 0.0]) if enable else None
+
+
+    def timing_report(self, count=20):
+        '''
+        (total seconds, calls, statement) for the statements that took
+        longest in total
+        '''
+        if not self.timings:
+            return []
+
+        report = [(total, calls, stmt) for stmt, (calls, total) in self.timings.items()]
+        return sorted(report, reverse=True)[:count]
+
+
     def execute_qmarks(self, stmt, value_lists, row_dicts=True):
         '''
         value_lists is a list of lists (or iterable of iterables). Each of
@@ -145,17 +195,21 @@ class SqliteDB(object):
         return self.execute(stmt, flattened, row_dicts)
 
 
-    def _prepare_insert(self, table, valuedict):
+    def _prepare_insert(self, table, valuedict, verb='insert'):
         '''
         shared code for insert and insert_many
         '''
         columns = list(valuedict.keys())  # self.columns(table) - foobars with automatic colums -
                                     # it seems we can't get hold of autoincrement and such
-        qmarks = list('?' * len(columns))
-        qmarks = ','.join(qmarks)
-        stmt = 'insert into %s (%s) values (%s)' % (table, ', '.join(columns), qmarks)
+        return columns, self._insert_stmt(table, columns, verb)
+
 
-        return columns, stmt
+    def _insert_stmt(self, table, columns, verb='insert'):
+        '''
+        verb may be 'insert', 'insert or ignore' or 'insert or replace'
+        '''
+        qmarks = ','.join('?' * len(columns))
+        return '%s into %s (%s) values (%s)' % (verb, table, ', '.join(columns), qmarks)
 
 
     def insert(self, table, valuedict):
@@ -169,7 +223,27 @@ class SqliteDB(object):
         return self.execute(stmt, vals)
 
 
-    def insert_many(self, table, valuedicts):
+    def executemany(self, stmt, rows):
+        '''
+        like execute, for many rows of values at once. Returns the cursor,
+        whose rowcount tells how many rows were changed in total.
+        '''
+        c = self.get_cursor(False)
+
+        if self.timings is not None:
+            start = time.perf_counter()
+
+        c.executemany(stmt, rows)
+
+        if self.timings is not None:
+            entry = self.timings[' '.join(stmt.split())]
+            entry[0] += 1
+            entry[1] += time.perf_counter() - start
+
+        return c
+
+
+    def insert_many(self, table, valuedicts, verb='insert'):
         '''
         test if .executemany can speed things up.
         We assume that all valuedicts are created equal.
@@ -177,11 +251,15 @@ class SqliteDB(object):
 
         Well, after testing it on the two longest tables in the mbib database,
         it appears that speed-up is marginal. Not worth any code contortions.
+        Update: it is worth it when there are thousands of rows, but insert_rows
+        saves making dicts in the first place.
         '''
+        valuedicts = list(valuedicts)
+
         if len(valuedicts) == 0:
             return
 
-        columns, stmt = self._prepare_insert(table, valuedicts[0])
+        columns, stmt = self._prepare_insert(table, valuedicts[0], verb)
         valuetuples = []
         for vd in valuedicts:
             valuetuples.append(tuple([vd[col] for col in columns]))
@@ -189,6 +267,51 @@ class SqliteDB(object):
         return self.executemany(stmt, valuetuples)
 
 
+    def insert_rows(self, table, columns, rows, verb='insert'):
+        '''
+        insert tuples of values for the given columns with a single statement.
+        Returns the cursor, or None if there were no rows.
+        '''
+        rows = list(rows)
+
+        if len(rows) == 0:
+            return
+
+        return self.executemany(self._insert_stmt(table, columns, verb), rows)
+
+
+    def insert_or_ignore(self, table, columns, rows):
+        '''
+        like insert_rows, but skip rows that violate a uniqueness constraint.
+        The cursor's rowcount tells how many went in.
+        '''
+        return self.insert_rows(table, columns, rows, verb='insert or ignore')
+
+
+    def upsert(self, table, columns, rows, key_columns):
+        '''
+        insert rows, or update the other columns of those that already exist
+        with the same values in key_columns. Unlike 'insert or replace', this
+        doesn't delete the old row, so nothing cascades.
+        '''
+        updates = [c for c in columns if c not in key_columns]
+
+        if updates:
+            action = 'update set ' + ', '.join('%s = excluded.%s' % (c, c) for c in updates)
+        else:
+            action = 'nothing'
+
+        rows = list(rows)
+
+        if len(rows) == 0:
+            return
+
+        stmt = self._insert_stmt(table, columns) + \
+               ' on conflict (%s) do %s' % (', '.join(key_columns), action)
+
+        return self.executemany(stmt, rows)
+
+
     def close(self):
         '''
         close down connection if no longer needed
@@ -196,6 +319,7 @@ class SqliteDB(object):
         assert self._connection is not None, "no connection has been opened"
         self._connection.close()
         self._connection = None
+        self._cursors = {}
 
 
     def commit(self):
@@ -209,8 +333,7 @@ class SqliteDB(object):
         Does this supply .executescript? Apparently so,
         since the call goes through.
         '''
-        conn = self.get_connection()
-        return getattr(conn, att)
+        return getattr(self.get_connection(), att)
 
 
 
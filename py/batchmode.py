@@ -21,6 +21,20 @@ class Plumbing(object):
         '''
         return os.path.realpath(os.getenv("mbib_db", None) or expanded_path('dbfile'))
 
+    def db_mtime(self, db):
+        '''
+        when the database last changed. With a write-ahead log, commits go
+        to the -wal file and leave the database file itself alone until
+        the next checkpoint.
+        '''
+        wal = db + '-wal'
+        mtime = os.stat(db).st_mtime
+
+        if os.path.exists(wal):
+            mtime = max(mtime, os.stat(wal).st_mtime)
+
+        return mtime
+
     def imex(self):
         if self._imex is None:
             from imex import Imex
@@ -30,9 +44,21 @@ class Plumbing(object):
     def hub(self):
         if self._hub is None:
             from hub import hub
+            hub.subscribe('errors', self.report)
+            hub.subscribe('message', self.report)
             self._hub = hub
         return self._hub
 
+    def report(self, errors, **kw):
+        '''
+        there is no user interface, so errors and messages go to stderr
+        '''
+        if isinstance(errors, str):
+            errors = [errors]
+
+        for error in errors:
+            print(error, file=sys.stderr)
+
     def db(self):
         if self._db is None:
             self._db = self.hub().sqlite
@@ -219,7 +245,7 @@ class Jabrefy(Plumbing):
         if os.path.exists(full_outfile_name):
             if not clobber and \
                 (os.stat(infile_name).st_mtime <= os.stat(full_outfile_name).st_mtime) and \
-                (os.stat(db).st_mtime <= os.stat(full_outfile_name).st_mtime):
+                (self.db_mtime(db) <= os.stat(full_outfile_name).st_mtime):
                 sys.exit("File %s is up to date - exiting" % full_outfile_name)
             else:
                 os.remove(full_outfile_name)
@@ -276,17 +302,14 @@ class SyncBibtex(Plumbing):
     '''
     def __call__(self):
         '''
-        synchronize database with default bibtex file. Come to think of it, we should
-        probably check the file date on the core database and the bibtexfile.
+        synchronize database with default bibtex file. We don't go by file dates;
+        with a write-ahead log, the database file doesn't change on commit. The
+        export digest below tells us whether anything needs writing.
         '''
         db = self.dbfile()
         bt = os.getenv('mbib_target') or config['paths']['bibtex_export']
         clobber = os.getenv('mbib_clobber', False)
 
-        if not clobber and os.path.exists(bt) and \
-            (os.stat(db).st_mtime <= os.stat(bt).st_mtime):
-            sys.exit("File %s is up to date - exiting" % bt)
-
         folder_name = os.getenv('mbib_folder')
 
         if folder_name is None:
@@ -302,7 +325,20 @@ class SyncBibtex(Plumbing):
             else:
                 sys.exit("Database %s contains no folders named '%s'" % (db, folder_name))
 
-        self.hub().export_bibtex(folder_ids=id_list, file_name=bt, batch=False)
+        # the database file may well have changed in ways that don't affect the
+        # export, e.g. selections or other folders. Compare what we would write
+        # against what we wrote last time.
+        imex = self.imex()
+        digest = imex.export_digest(imex.get_export_ids(folder_ids=id_list))
+        stmt = "select digest from sync_state where target = (?)"
+        last_digest = self.db().execute(stmt, [bt], row_dicts=False).fetchone()
+
+        if not clobber and os.path.exists(bt) and last_digest == (digest,):
+            sys.exit("File %s is up to date - exiting" % bt)
+
+        if imex.export_bibtex(folder_ids=id_list, file_name=bt, batch=False) is not None:
+            self.db().upsert('sync_state', ('target', 'digest'), [(bt, digest)], ('target',))
+            self.db().commit()
 
 
 class AuxExport(Plumbing):
@@ -0,0 +1,21 @@
+'''
+performance benchmarks for the database core, the search, and import and
+export. Run from the py directory:
+
+    python3 -m benchmarks --refs 20000 --output results.json
+    python3 -m benchmarks --refs 20000 --compare results.json
+
+Each run builds a fresh synthetic database from resources/default.sqlite
+(see synthetic.py), times a fixed set of cases against it and writes the
+timings as JSON. With --compare, the timings are set against those of an
+earlier run, so that regressions stand out.
+
+    python3 -m benchmarks.startup
+
+reports the time it takes to import hub, and which imports it goes to.
+
+    python3 -m benchmarks.network
+
+checks retries and partial failures of the doi and pubmed imports against a
+local stand-in server.
+'''
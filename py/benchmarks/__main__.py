@@ -0,0 +1,215 @@
+'''
+build a synthetic database, time the benchmark cases against it, and write
+the results as JSON. See __init__.py for usage.
+'''
+import argparse, json, os, platform, shutil, sqlite3, statistics, subprocess, sys, tempfile, time
+
+from benchmarks.synthetic import Generator
+
+py_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+mbib_dir = os.path.dirname(py_dir)
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(prog='python3 -m benchmarks', description='time mbib core operations')
+    ap.add_argument('--refs', type=int, default=5000, help='references in the synthetic database')
+    ap.add_argument('--depth', type=int, default=3, help='folder levels below References')
+    ap.add_argument('--fanout', type=int, default=4, help='subfolders per folder')
+    ap.add_argument('--cross-ratio', type=float, default=0.2, help='fraction of references listed in two folders')
+    ap.add_argument('--abstract-words', type=int, default=150, help='average abstract length')
+    ap.add_argument('--import-refs', type=int, default=2000, help='records in the bibtex file to parse and import')
+    ap.add_argument('--repeat', type=int, default=3, help='runs per case; the minimum counts')
+    ap.add_argument('--seed', type=int, default=1)
+    ap.add_argument('--only', nargs='*', help='run only cases whose names start with these')
+    ap.add_argument('--output', help='write JSON results to this file instead of stdout')
+    ap.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    ap.add_argument('--keep', action='store_true', help="don't delete the synthetic data afterwards")
+    ap.add_argument('--statements', type=int, default=0, metavar='N',
+                    help='also report the N sql statements that took longest in total')
+    return ap.parse_args()
+
+
+def git_revision():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=mbib_dir,
+                                      stderr=subprocess.DEVNULL)
+        return out.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Runner(object):
+    '''
+    times named cases. setup runs before every repetition but isn't timed.
+    '''
+    def __init__(self, repeat, only=None):
+        self.repeat = repeat
+        self.only = only
+        self.results = {}
+
+    def __call__(self, name, func, setup=None, repeat=None):
+        if self.only and not any(name.startswith(o) for o in self.only):
+            return
+
+        runs = []
+
+        for i in range(repeat or self.repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            func()
+            runs.append(time.perf_counter() - start)
+
+        self.results[name] = dict(min=min(runs), median=statistics.median(runs), runs=runs)
+        print('%-28s %9.4f s' % (name, min(runs)), file=sys.stderr)
+
+
+def run_cases(run, workdir, generator, bib_file, statements=0):
+    '''
+    the application modules can only be imported once the environment
+    points them to the synthetic database.
+    '''
+    from hub import hub
+    from bibtex_reader import BibtexReader
+    from tigkas_bibtexparser import Parser
+
+    # no user interface - just keep the errors
+    errors = []
+    hub.subscribe('errors', lambda e, *a, **kw: errors.append(e))
+
+    db, sqlite = hub.coredb, hub.sqlite
+
+    if statements:
+        sqlite.enable_timing()
+    references = db.special_branch_nodes['References']
+    bib_out = os.path.join(workdir, 'export.bib')
+    html_out = os.path.join(workdir, 'export.html')
+
+    def walk(node=references):
+        for child in db.get_child_nodes(node) or []:
+            if db.is_branch(child):
+                walk(child)
+
+    def clear_bibtex_cache():
+        sqlite.execute('delete from bibtex_cache')
+        sqlite.commit()
+
+    last_ref_id = sqlite.execute('select max(ref_id) from refs').fetchvalue()
+
+    def remove_imported():
+        sqlite.execute('delete from refs where ref_id > (?)', [last_ref_id])
+        sqlite.commit()
+        db.clear_cache()
+
+    run('tree_walk_cold', walk, setup=db.clear_cache)
+    run('tree_walk_warm', walk)
+    run('prepopulate_cache', db._prepopulate_cache)
+
+    searches = dict(
+        title = dict(title='membrane'),
+        author = dict(author='smith'),
+        abstract_substring = dict(abstract='%kinase receptor%'),
+        year_range = dict(year='>2010'),
+        combined = dict(title='protein', author='chen', year='>1990'),
+        selective_last = dict(abstract='%kinase%', journal='%bio%', volume='42'),
+    )
+
+    # the searches themselves, not the result cache
+    searcher = hub.search_references.__self__
+
+    for label, data in searches.items():
+        run('search_' + label, lambda data=data: hub.search_references(data), setup=searcher._results.clear)
+
+    run('search_cached', lambda: hub.search_references(searches['title']))
+
+    run('export_bibtex_cold', lambda: hub.export_bibtex(folder_ids=[references[1]], file_name=bib_out, batch=True),
+        setup=clear_bibtex_cache)
+    run('export_bibtex_cached', lambda: hub.export_bibtex(folder_ids=[references[1]], file_name=bib_out, batch=True))
+    run('export_html', lambda: hub.export_html(node=references, file_name=html_out, batch=True), repeat=1)
+
+    run('parse_bibtex', lambda: BibtexReader(open(bib_file))())
+    run('parse_bibtex_old', lambda: Parser(open(bib_file).read())(), repeat=1)
+
+    run('import_bibtex', lambda: hub.import_bibtex(references, bib_file), setup=remove_imported)
+
+    report = [dict(seconds=total, calls=calls, statement=stmt)
+              for total, calls, stmt in sqlite.timing_report(statements)]
+
+    return errors, report
+
+
+def compare(results, earlier):
+    '''
+    print ratios of current to earlier minimum timings
+    '''
+    print('\n%-28s %10s %10s %8s' % ('case', 'before', 'now', 'ratio'), file=sys.stderr)
+
+    for name, now in sorted(results.items()):
+        before = earlier['results'].get(name)
+        if before is None:
+            continue
+        ratio = now['min'] / before['min'] if before['min'] else float('inf')
+        flag = '  <-- slower' if ratio > 1.2 else ''
+        print('%-28s %10.4f %10.4f %8.2f%s' % (name, before['min'], now['min'], ratio, flag), file=sys.stderr)
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix='mbib_bench_')
+
+    generator = Generator(refs=args.refs, depth=args.depth, fanout=args.fanout,
+                          cross_ratio=args.cross_ratio, abstract_words=args.abstract_words,
+                          seed=args.seed)
+
+    db_file = os.path.join(workdir, 'bench.sqlite')
+    bib_file = os.path.join(workdir, 'import.bib')
+
+    start = time.perf_counter()
+    generator.make_database(db_file)
+    generator.make_bibtex(bib_file, args.import_refs)
+    print('synthetic data ready in %.1f s (%s)' % (time.perf_counter() - start, workdir), file=sys.stderr)
+
+    os.environ['mbib_db'] = db_file
+    os.environ['mbib_dir'] = mbib_dir
+    os.environ.setdefault('mbib_ini', os.path.join(mbib_dir, 'resources', 'default.ini'))
+
+    run = Runner(args.repeat, args.only)
+
+    try:
+        errors, statements = run_cases(run, workdir, generator, bib_file, args.statements)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = dict(
+        meta = dict(
+            revision = git_revision(),
+            timestamp = time.strftime('%Y-%m-%dT%H:%M:%S'),
+            python = platform.python_version(),
+            sqlite = sqlite3.sqlite_version,
+            platform = platform.platform(),
+            settings = dict(generator.settings(), import_refs=args.import_refs,
+                            repeat=args.repeat, seed=args.seed),
+            errors = len(errors),
+        ),
+        results = run.results
+    )
+
+    if statements:
+        results['statements'] = statements
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(run.results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+'''
+check the retry and partial failure handling of the doi and pubmed imports
+against a local stand-in server, rather than the real thing. Run from the py
+directory:
+
+    python3 -m benchmarks.network
+
+The server answers doi lookups and pubmed efetch requests. Each check tells
+it which identifiers should fail once and then succeed, which should always
+fail, and which don't exist; the last get a 404, and shouldn't be asked for
+twice. The pubmed part needs requests and lxml, and is skipped without them.
+'''
+import collections, os, shutil, sys, tempfile, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote
+
+py_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+mbib_dir = os.path.dirname(py_dir)
+
+_article = '''
+<PubmedArticle>
+  <MedlineCitation>
+    <Article>
+      <Journal><Title>Journal of Checks</Title><JournalIssue><Volume>1</Volume>
+        <PubDate><Year>2001</Year></PubDate></JournalIssue></Journal>
+      <ArticleTitle>Article %(pmid)s</ArticleTitle>
+      <AuthorList><Author><LastName>Doe</LastName><ForeName>Jane</ForeName></Author></AuthorList>
+    </Article>
+  </MedlineCitation>
+  <PubmedData><ArticleIdList><ArticleId IdType="pubmed">%(pmid)s</ArticleId></ArticleIdList></PubmedData>
+</PubmedArticle>'''
+
+_bibtex = '@article{%(key)s, title = {Record %(doi)s}, author = {Doe, Jane}, year = {2001}, doi = {%(doi)s}}'
+
+
+class Server(ThreadingHTTPServer):
+    '''
+    counts the requests for each doi or chunk of pmids, so that we can
+    tell how often the client asked
+    '''
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+
+        self.flaky = set()
+        self.broken = set()
+        self.missing = set()
+
+    def count(self, key):
+        with self.lock:
+            self.requests[key] += 1
+            return self.requests[key]
+
+    def fails(self, ids, attempt):
+        return bool(self.broken & ids) or (attempt == 1 and bool(self.flaky & ids))
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *a):
+        pass
+
+    def reply(self, code, body=b'', content_type='text/plain'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        doi = unquote(self.path.split('/doi/', 1)[-1])
+        attempt = self.server.count(doi)
+
+        if doi in self.server.missing:
+            self.reply(404)
+        elif self.server.fails({doi}, attempt):
+            self.reply(503)
+        else:
+            key = ''.join(c for c in doi if c.isalnum())
+            self.reply(200, (_bibtex % dict(key=key, doi=doi)).encode(), 'application/x-bibtex')
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        pmids = form['id'][0].split(',')
+        attempt = self.server.count(','.join(pmids))
+
+        if self.server.fails(set(pmids), attempt):
+            self.reply(503)
+        else:
+            body = '<PubmedArticleSet>%s</PubmedArticleSet>' % ''.join(_article % dict(pmid=p) for p in pmids)
+            self.reply(200, body.encode(), 'text/xml')
+
+
+class Checks(object):
+
+    def __init__(self):
+        self.failures = 0
+
+    def __call__(self, label, ok, detail=''):
+        print('%-4s %s%s' % ('ok' if ok else 'FAIL', label, ' (%s)' % detail if detail and not ok else ''))
+        self.failures += not ok
+
+
+def check_doi(check, server, hub, errors):
+    imex = hub.import_doi.__self__
+    imex.doi_base_url = server.url + 'doi/'
+
+    server.flaky.add('10.1/flaky.2')
+    server.broken.add('10.1/broken.3')
+    server.missing.add('10.1/missing.4')
+
+    references = hub.coredb.special_branch_nodes['References']
+    count = lambda: hub.sqlite.execute('select count(*) from refs').fetchvalue()
+    before = count()
+
+    hub.import_doi(references, '10.1/ok.1 10.1/flaky.2 10.1/broken.3 10.1/missing.4 10.1/ok.5')
+    requests = server.requests
+
+    check('doi: good and flaky lookups imported', count() - before == 3, '%d new' % (count() - before))
+    check('doi: flaky lookup retried once', requests['10.1/flaky.2'] == 2, requests['10.1/flaky.2'])
+    check('doi: broken lookup given up after all retries', requests['10.1/broken.3'] == 3,
+          requests['10.1/broken.3'])
+    check('doi: missing doi asked for only once', requests['10.1/missing.4'] == 1, requests['10.1/missing.4'])
+
+    reported = [e for e in errors if 'retrieval failed' in e]
+    check('doi: failures reported', reported and reported[0].endswith('10.1/broken.3, 10.1/missing.4'), errors)
+
+
+def check_pubmed(check, server):
+    try:
+        import requests, lxml
+    except ImportError as e:
+        print('skip pubmed: %s' % e)
+        return
+
+    from pubmed_retrieval import PubmedImporter
+
+    pmids = [str(p) for p in range(101, 111)]
+
+    # with chunks of two, the second one is flaky and the fourth broken
+    server.flaky.add('103')
+    server.broken.add('107')
+
+    importer = PubmedImporter(' '.join(pmids))
+    importer.efetch_base_url = server.url + 'efetch'
+
+    records, failed = importer()
+    got = [r['pmid'] for r in records]
+
+    check('pubmed: records come back in chunk order', got == pmids[:6] + pmids[8:], got)
+    check('pubmed: broken chunk reported', failed == ['107', '108'], failed)
+    check('pubmed: flaky chunk retried once', server.requests['103,104'] == 2, server.requests['103,104'])
+    check('pubmed: broken chunk still pending', importer.pending == [3], importer.pending)
+
+    server.broken.clear()
+    records, failed = importer()
+    got = [r['pmid'] for r in records]
+
+    check('pubmed: retry fetches only the missing chunk and returns only its records',
+          got == ['107', '108'] and server.requests['101,102'] == 1, got)
+    check('pubmed: nothing left over', failed == [] and importer.pending == [], failed)
+
+
+def main():
+    workdir = tempfile.mkdtemp(prefix='mbib_network_')
+
+    # a copy of the empty database, so that we don't touch the real one
+    db_file = os.path.join(workdir, 'network.sqlite')
+    shutil.copy(os.path.join(mbib_dir, 'resources', 'default.sqlite'), db_file)
+
+    os.environ['mbib_db'] = db_file
+    os.environ['mbib_dir'] = mbib_dir
+    os.environ.setdefault('mbib_ini', os.path.join(mbib_dir, 'resources', 'default.ini'))
+
+    from config import config
+
+    config['network'].update(retries='2', backoff='0.01', pubmed_chunk_size='2', pubmed_rate='0')
+
+    server = Server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    check = Checks()
+
+    try:
+        from hub import hub
+
+        errors = []
+        hub.subscribe('errors', lambda e, *a, **kw: errors.append(e))
+
+        check_doi(check, server, hub, errors)
+        check_pubmed(check, server)
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    sys.exit(1 if check.failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+'''
+report how long mbib takes to start, and which imports the time goes to.
+Run from the py directory:
+
+    python3 -m benchmarks.startup
+    python3 -m benchmarks.startup --ui --top 30
+
+Each run imports hub (or bibapp, with --ui) in a fresh interpreter under
+python's -X importtime, once as it is and once with all the modules that
+hub otherwise imports only on first use. The difference is what lazy
+loading saves at startup.
+'''
+import argparse, os, re, shutil, subprocess, sys, tempfile
+
+py_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+mbib_dir = os.path.dirname(py_dir)
+
+# the child prints its own wall time, so that interpreter startup doesn't count
+_child_code = '''
+import time
+start = time.perf_counter()
+import %(module)s
+from hub import hub
+if %(eager)s:
+    hub._load_providers()
+print('wall', time.perf_counter() - start)
+'''
+
+_importtime_re = re.compile(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)')
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(prog='python3 -m benchmarks.startup', description='time mbib startup')
+    ap.add_argument('--ui', action='store_true', help='import bibapp, which needs urwid, instead of hub')
+    ap.add_argument('--repeat', type=int, default=5, help='runs per variant; the fastest counts')
+    ap.add_argument('--top', type=int, default=15, help='how many of the slowest imports to list')
+    return ap.parse_args()
+
+
+def run_once(module, eager, env):
+    '''
+    returns wall time and a dict of module name -> (self, cumulative) microseconds
+    '''
+    code = _child_code % dict(module=module, eager=eager)
+
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=py_dir, env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+    if proc.returncode != 0:
+        sys.exit(proc.stderr)
+
+    wall = float(proc.stdout.split('wall')[-1])
+    imports = {}
+
+    for mo in _importtime_re.finditer(proc.stderr):
+        imports[mo.group(4)] = (int(mo.group(1)), int(mo.group(2)))
+
+    return wall, imports
+
+
+def best_of(repeat, *a):
+    return min((run_once(*a) for i in range(repeat)), key=lambda run: run[0])
+
+
+def main():
+    args = parse_args()
+    module = 'bibapp' if args.ui else 'hub'
+    workdir = tempfile.mkdtemp(prefix='mbib_startup_')
+
+    # a copy of the empty database, so that we don't back up or upgrade the real one
+    db_file = os.path.join(workdir, 'startup.sqlite')
+    shutil.copy(os.path.join(mbib_dir, 'resources', 'default.sqlite'), db_file)
+
+    env = dict(os.environ, mbib_db=db_file, mbib_dir=mbib_dir)
+    env.setdefault('mbib_ini', os.path.join(mbib_dir, 'resources', 'default.ini'))
+
+    try:
+        lazy_wall, lazy = best_of(args.repeat, module, False, env)
+        eager_wall, eager = best_of(args.repeat, module, True, env)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print('import %s: %.1f ms, with all modules loaded: %.1f ms'
+          % (module, lazy_wall * 1000, eager_wall * 1000))
+
+    print('\nslowest imports at startup (ms):\n')
+    print('%-32s %8s %8s' % ('module', 'self', 'total'))
+
+    slowest = sorted(lazy.items(), key=lambda item: -item[1][0])[:args.top]
+
+    for name, (own, total) in slowest:
+        print('%-32s %8.1f %8.1f' % (name, own / 1000, total / 1000))
+
+    deferred = sorted(set(eager) - set(lazy))
+    print('\nimported only when needed: %s' % ', '.join(deferred))
+
+
+if __name__ == '__main__':
+    main()
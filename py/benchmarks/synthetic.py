@@ -0,0 +1,153 @@
+'''
+generate synthetic databases and bibtex files for benchmarking.
+
+This module only uses sqlite3 directly, so that it can run before config
+and hub are imported - those pick up the database path from the environment.
+'''
+import os, random, shutil, sqlite3
+
+words = '''
+    membrane protein lipid bilayer kinase receptor signal transduction cell
+    mitochondria transport channel binding structure dynamics simulation
+    enzyme inhibitor regulation expression gene mutation domain interaction
+    folding stability assay fluorescence microscopy spectroscopy oxidation
+    peptide antibody bacteria yeast plasma vesicle fusion cholesterol ion
+    '''.split()
+
+surnames = '''
+    Smith Jones Miller Garcia Chen Wang Kumar Nguyen Schmidt Rossi Tanaka
+    Kowalski Novak Ivanov Silva Dubois Andersen Murphy Cohen Okafor Palmer
+    '''.split()
+
+journals = '''
+    Biochemistry;Nature;Science;Journal of Biological Chemistry;Cell;
+    Biophysical Journal;Biochimica et Biophysica Acta;PLoS One;eLife
+    '''.strip().split(';')
+
+default_sqlite = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              '..', '..', 'resources', 'default.sqlite')
+
+
+class Generator(object):
+    '''
+    size and shape of the synthetic data:
+
+    refs            number of references
+    depth           levels of folders below References
+    fanout          subfolders per folder
+    cross_ratio     fraction of references that are listed in a second folder
+    abstract_words  average length of abstracts
+    seed            for the random number generator, so that runs are comparable
+    '''
+    def __init__(self, refs=5000, depth=3, fanout=4, cross_ratio=0.2, abstract_words=150, seed=1):
+        self.refs = refs
+        self.depth = depth
+        self.fanout = fanout
+        self.cross_ratio = cross_ratio
+        self.abstract_words = abstract_words
+        self.random = random.Random(seed)
+
+
+    def settings(self):
+        return dict(refs=self.refs, depth=self.depth, fanout=self.fanout,
+                    cross_ratio=self.cross_ratio, abstract_words=self.abstract_words)
+
+
+    def text(self, n):
+        return ' '.join(self.random.choice(words) for i in range(n))
+
+
+    def record(self, i):
+        '''
+        field values for one reference
+        '''
+        r = self.random
+        authors = ['%s, %s' % (r.choice(surnames), r.choice('ABCDEFGHJKLMNPRST')) \
+                   for j in range(r.randint(1, 6))]
+        year = r.randint(1970, 2020)
+        n = max(1, int(r.gauss(self.abstract_words, self.abstract_words / 3)))
+
+        return dict(
+            reftype = 'article',
+            bibtexkey = '%s%s-%d' % (authors[0].split(',')[0], year, i),
+            title = self.text(r.randint(5, 15)).capitalize(),
+            year = str(year),
+            author = ' and '.join(authors),
+            journal = r.choice(journals),
+            volume = str(r.randint(1, 500)),
+            pages = '%d-%d' % (i, i + r.randint(1, 20)),
+            abstract = self.text(n),
+            keywords = self.text(3),
+            doi = '10.9999/bench.%d' % i,
+        )
+
+
+    def make_database(self, path):
+        '''
+        copy the empty database template to path and fill it
+        '''
+        shutil.copy(default_sqlite, path)
+        db = sqlite3.connect(path)
+        db.execute('pragma foreign_keys=on')
+
+        fields = dict(db.execute('select name, field_id from fields'))
+        reftypes = dict(db.execute('select name, reftype_id from reftypes'))
+        references_id = db.execute("select branch_id from branches where name='References'").fetchone()[0]
+
+        # folders, level by level
+        next_id = db.execute('select max(branch_id) from branches').fetchone()[0] + 1
+        level, folders = [references_id], []
+
+        for d in range(self.depth):
+            below = []
+            for parent_id in level:
+                for k in range(self.fanout):
+                    db.execute('insert into branches (branch_id, parent_id, name) values (?,?,?)',
+                               [next_id, parent_id, '%s %d' % (self.random.choice(words), next_id)])
+                    below.append(next_id)
+                    next_id += 1
+            folders.extend(below)
+            level = below
+
+        folders = folders or [references_id]
+
+        next_ref = db.execute('select coalesce(max(ref_id), 0) from refs').fetchone()[0] + 1
+
+        for i in range(self.refs):
+            ref_id = next_ref + i
+            rec = self.record(i)
+
+            db.execute('insert into refs (ref_id, reftype_id, bibtexkey, title, year) values (?,?,?,?,?)',
+                       [ref_id, reftypes[rec['reftype']], rec['bibtexkey'], rec['title'], rec['year']])
+
+            for name in 'author journal volume pages abstract keywords'.split():
+                db.execute('insert into optional (ref_id, field_id, content) values (?,?,?)',
+                           [ref_id, fields[name], rec[name]])
+
+            db.execute('insert into uniqid (ref_id, field_id, content) values (?,?,?)',
+                       [ref_id, fields['doi'], rec['doi']])
+
+            homes = [self.random.choice(folders)]
+            if self.random.random() < self.cross_ratio:
+                homes.append(self.random.choice(folders))
+
+            for branch_id in set(homes):
+                db.execute('insert into reflink (ref_id, branch_id) values (?,?)', [ref_id, branch_id])
+
+        db.commit()
+        db.close()
+
+
+    def make_bibtex(self, path, count):
+        '''
+        write count records to a bibtex file, with keys that don't clash
+        with those in the database
+        '''
+        with open(path, 'w') as out:
+            for i in range(count):
+                rec = self.record(self.refs + i)
+                rec['doi'] = '10.9999/import.%d' % i
+                lines = ['@%s{%s,' % (rec.pop('reftype'), rec.pop('bibtexkey'))]
+                lines += ['    %s = {%s},' % item for item in rec.items()]
+                lines.append('}\n\n')
+                out.write('\n'.join(lines))
@@ -2,6 +2,7 @@
 application object and main UI helper classes
 '''
 import os, sys, time, string, traceback
+from collections import OrderedDict
 
 import urwid
 from urwidtrees.widgets import TreeBox
@@ -12,10 +13,12 @@ from urwid.util import is_wide_char
 from urwidtools import dialog, application, widgets
 from hub import hub
 from config import config
+import help4mbib, ui
 
 class MyTreeBox(TreeBox):
 
     max_history = 20
+    typeahead_timeout = 1.0     # seconds within which typed letters add up
 
     exposed = '''
               toggle_view
@@ -40,6 +43,8 @@ class MyTreeBox(TreeBox):
         self._dtree = dtree
         self.current_focus_element = None
         self.last_mouse_press = -3600
+        self._typed = ''
+        self._typed_at = -3600
 
         self.__super.__init__(*a, **kw)
 
@@ -55,6 +60,11 @@ class MyTreeBox(TreeBox):
         for key in self.exposed.strip().split():
             hub.register(key, getattr(self, key))
 
+        # follow what the database code announces
+        hub.subscribe('refresh_tree', self.refresh)
+        hub.subscribe('focus_node', self.set_focus)
+        hub.subscribe('add_to_history', self.add_to_history)
+
 
     def delete_from_history(self, node):
         '''
@@ -223,26 +233,32 @@ class MyTreeBox(TreeBox):
 
     def jump_letter(self, letter):
         '''
-        jump among siblings by first letter. keep all of these jumped-to
-        references in the history.
+        jump among siblings by the beginning of their keys. Letters typed in
+        quick succession add up, so that 'smi' goes to Smith2008; typing the
+        same letter again moves on to the next match. keep all of these
+        jumped-to references in the history.
         '''
-        tree = self._dtree
-        get_text = hub.get_node_text
+        now = time.monotonic()
+
+        if now - self._typed_at < self.typeahead_timeout:
+            self._typed += letter
+        else:
+            self._typed = letter
+
+        self._typed_at = now
+
+        # 'sss' steps through everything starting with 's'
+        cycling = self._typed == letter * len(self._typed)
+        prefix = letter if cycling else self._typed
 
         current = self.focus_element()
         self.add_to_history(current)
 
-        siblings = tree._get_siblings(current)
-
-        next_index = siblings.index(current) + 1
-        rotated_siblings = siblings[next_index:] + siblings[:next_index]
+        sibling = hub.find_sibling(current, prefix, include_self=not cycling)
 
-        for sibling in rotated_siblings:
-            key, title = get_text(sibling)
-            if key.lower().startswith(letter):
-                self.set_focus(sibling)
-                self.add_to_history(sibling)
-                break
+        if sibling is not None and sibling != current:
+            self.set_focus(sibling)
+            self.add_to_history(sibling)
 
 
     def keypress(self, size, key):
@@ -297,17 +313,39 @@ class DbTree(Tree):
     '''
     root = "Stuff" # seems to be needed but never shows up.
 
+    # urwid asks for the same few screenfuls of positions over and over while
+    # scrolling, so we keep the widgets of the most recently shown nodes.
+    max_widgets = 500
+
     def __init__(self, *a, **kw):
         self.debug = False
+        self._widgets = OrderedDict()   # node -> (display info, widget)
         super(DbTree, self).__init__(*a, **kw)
 
 
     def __getitem__(self, pos):
         '''
         obtain one tree item for display. Must check back with the database
-        to look for updates.
+        to look for updates; the display info comes from the cache in coredb,
+        and we only make a new widget if it has changed.
         '''
-        text_tuple, selected = hub.get_node_display_info(pos)
+        display_info = hub.get_node_display_info(pos), self.debug
+        cached = self._widgets.get(pos, None)
+
+        if cached is not None and cached[0] == display_info:
+            self._widgets.move_to_end(pos)
+            return cached[1]
+
+        widget = self._make_widget(pos, *display_info[0])
+        self._widgets[pos] = (display_info, widget)
+
+        if len(self._widgets) > self.max_widgets:
+            self._widgets.popitem(last=False)
+
+        return widget
+
+
+    def _make_widget(self, pos, text_tuple, selected):
         key, title = text_tuple
 
         if selected == 0:
@@ -326,18 +364,6 @@ class DbTree(Tree):
             return widget
 
 
-    def _get_siblings(self, pos):
-        """
-        lists the parent directory of pos
-        """
-        parent = hub.get_parent_node(pos)
-
-        if parent is None:
-            return [pos]
-
-        return hub.get_child_nodes(parent)
-
-
     # Tree API
     def parent_position(self, pos):
         return hub.get_parent_node(pos)
@@ -364,41 +390,16 @@ class DbTree(Tree):
         return None if not children else children[-1]
 
 
-    def _sibling_pos(self, pos, siblings):
-        '''
-        shared code for next_sibling_position and prev_sibling_position
-
-        hack around the problem of object identity
-        '''
-        return siblings.index(pos)
-
-
     def next_sibling_position(self, pos):
         '''
-        where is this actually used?
+        where is this actually used? Moving down through the tree - so we
+        let coredb look up the position instead of searching the siblings.
         '''
-        siblings = self._get_siblings(pos)
-        try:
-            myindex = siblings.index(pos)
-            #hub.set_status_bar(str(siblings[0]))
-        except ValueError:
-            return None
-
-        if myindex + 1 < len(siblings):  # pos is not the last entry
-            return siblings[myindex + 1]
-        return None
+        return hub.get_sibling_node(pos, 1)
 
 
     def prev_sibling_position(self, pos):
-        siblings = self._get_siblings(pos)
-        try:
-            myindex = siblings.index(pos)
-        except ValueError:
-            return None
-
-        if myindex > 0:  # pos is not the first entry
-            return siblings[myindex - 1]
-        return None
+        return hub.get_sibling_node(pos, -1)
 
 
 class BibApp(application.Application):
@@ -454,6 +455,8 @@ class BibApp(application.Application):
         self._status = urwid.Text('', align='right')
         cols = urwid.Columns([left_bottom, self._status])
 
+        hub.subscribe('status', self.set_status)
+
         footer = urwid.AttrMap(cols, 'footer')
         #enclose all in a frame
         root_widget = urwid.Frame(wrapped_tree, footer=footer)
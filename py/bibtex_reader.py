@@ -0,0 +1,285 @@
+'''
+streaming BibTeX parser. Replaces tigkas_bibtexparser for imports.
+
+The input is read from a file object in blocks, and each entry is parsed
+as soon as its closing delimiter has been seen, so that we never hold
+more than one block plus one entry in memory. Records come out one at a
+time, in the same shape as from the old parser: a dict with reftype,
+bibtexkey and lowercase field names, with white space runs collapsed.
+
+@string definitions are remembered and substituted into later values,
+# concatenation is honored, @preamble contents are collected in
+.preambles, and @comment entries are skipped, as is any text outside
+of entries.
+
+Run this module with a .bib file as argument to compare its speed with
+the old parser.
+'''
+import re, io
+
+class BibtexError(Exception):
+    pass
+
+
+class BibtexReader(object):
+    '''
+    iterate over an instance to obtain the records
+    '''
+    block_size = 1 << 16
+
+    entry_start = re.compile(r'@\s*([A-Za-z][\w\-]*)\s*([{(])')
+    braces_or_quote = re.compile(r'[{}"]')
+    braces_parens_or_quote = re.compile(r'[{}()"]')
+
+    key_re = re.compile(r'\s*([^\s,]*)\s*(,|$)')
+    field_name = re.compile(r'\s*([^\s=,{}"#]+)\s*=\s*')
+    bare_word = re.compile(r'[^\s,#{}"=]+')
+    separator = re.compile(r'\s*(,|#|$)')
+
+    def __init__(self, source):
+        '''
+        source is a file object or a string
+        '''
+        if isinstance(source, str):
+            source = io.StringIO(source)
+
+        self.source = source
+        self.strings = {}
+        self.preambles = []
+
+
+    def _closing_brace(self, buf, start):
+        '''
+        position of the brace that closes one opened just before start,
+        or -1. Counting with find and count is much faster than looking
+        at each brace in turn.
+        '''
+        depth = 0
+
+        while True:
+            close = buf.find('}', start)
+
+            if close < 0:
+                return -1
+
+            depth += buf.count('{', start, close)
+
+            if depth == 0:
+                return close
+
+            depth -= 1
+            start = close + 1
+
+
+    def _find_end(self, buf, start, opening):
+        '''
+        position of the delimiter that closes the entry opened just before
+        start, or -1 if we haven't read that far yet. Entries delimited
+        with parentheses may contain unbalanced ones inside quoted values.
+        '''
+        if opening == '{':
+            return self._closing_brace(buf, start)
+
+        depth = 0
+        quoted = False
+
+        for mo in self.braces_parens_or_quote.finditer(buf, start):
+            c = mo.group()
+
+            if c == '{':
+                depth += 1
+            elif c == '}':
+                depth -= 1
+            elif depth == 0:
+                if c == '"':
+                    quoted = not quoted
+                elif c == ')' and not quoted:
+                    return mo.start()
+        return -1
+
+
+    def entries(self):
+        '''
+        yield (entry type, body) for each entry, reading more input as needed
+        '''
+        buf, pos, eof = '', 0, False
+
+        while True:
+            mo = self.entry_start.search(buf, pos)
+            end = -1
+
+            if mo is not None:
+                end = self._find_end(buf, mo.end(), mo.group(2))
+
+                if end >= 0:
+                    yield mo.group(1), buf[mo.end():end]
+                    pos = end + 1
+                    continue
+
+            if eof:
+                if mo is not None:
+                    raise BibtexError("unterminated entry '%s'" % buf[mo.start():mo.start()+60])
+                return
+
+            # keep what we haven't processed yet and read on. Text before the
+            # last @ outside of entries is comment and can go.
+            if mo is not None:
+                buf = buf[mo.start():]
+            else:
+                at = buf.rfind('@', pos)
+                buf = buf[at:] if at >= 0 else ''
+            pos = 0
+
+            block = self.source.read(self.block_size)
+            eof = not block
+            buf += block
+
+
+    def _delimited(self, body, pos):
+        '''
+        a value in braces or double quotes, starting at pos. Returns the text
+        inside the delimiters and the position after the closing one.
+        '''
+        if body[pos] == '{':
+            end = self._closing_brace(body, pos+1)
+
+            if end >= 0:
+                return body[pos+1:end], end+1
+        else:
+            depth = 0
+
+            for mo in self.braces_or_quote.finditer(body, pos+1):
+                c = mo.group()
+
+                if c == '{':
+                    depth += 1
+                elif c == '}':
+                    depth -= 1
+                elif depth == 0:
+                    return body[pos+1:mo.start()], mo.end()
+
+        raise BibtexError("unbalanced value '%s'" % body[pos:pos+60])
+
+
+    def parse_value(self, body, pos):
+        '''
+        a value is a sequence of braced or quoted strings, numbers and
+        @string names, joined by #. Returns the value and the position after it.
+        '''
+        parts = []
+
+        while True:
+            while pos < len(body) and body[pos].isspace():
+                pos += 1
+
+            if body[pos:pos+1] in ('{', '"'):
+                part, pos = self._delimited(body, pos)
+                parts.append(part)
+            else:
+                mo = self.bare_word.match(body, pos)
+                if mo is None:
+                    raise BibtexError("missing value at '%s'" % body[pos:pos+60])
+                word = mo.group()
+                parts.append(self.strings.get(word.lower(), word))
+                pos = mo.end()
+
+            mo = self.separator.match(body, pos)
+
+            if mo is None:
+                raise BibtexError("unexpected text at '%s'" % body[pos:pos+60])
+
+            if mo.group(1) != '#':
+                return ''.join(parts), pos
+
+            pos = mo.end()
+
+
+    def parse_fields(self, body, pos):
+        '''
+        yield (name, value) pairs
+        '''
+        while True:
+            mo = self.field_name.match(body, pos)
+
+            if mo is None:
+                if body[pos:].strip(', \t\r\n'):
+                    raise BibtexError("can't parse '%s'" % body[pos:pos+60])
+                return
+
+            value, pos = self.parse_value(body, mo.end())
+            yield mo.group(1).lower(), value
+
+            pos = self.separator.match(body, pos).end()
+
+
+    def clean(self, value):
+        return ' '.join(value.split())
+
+
+    def make_record(self, reftype, body):
+        mo = self.key_re.match(body)
+
+        record = dict(
+            reftype = reftype,
+            bibtexkey = mo.group(1)
+        )
+
+        for name, value in self.parse_fields(body, mo.end()):
+            value = self.clean(value)
+
+            if name == 'pages':
+                value = value.replace('--', '-').replace('–', '-')
+
+            record[name] = value
+
+        return record
+
+
+    def __iter__(self):
+        for entry_type, body in self.entries():
+            kind = entry_type.lower()
+
+            if kind == 'comment':
+                continue
+
+            elif kind == 'string':
+                for name, value in self.parse_fields(body, 0):
+                    self.strings[name] = value
+
+            elif kind == 'preamble':
+                value, pos = self.parse_value(body, 0)
+                self.preambles.append(self.clean(value))
+
+            else:
+                yield self.make_record(kind, body)
+
+
+    def __call__(self):
+        '''
+        same interface as tigkas_bibtexparser.Parser
+        '''
+        return list(self)
+
+
+
+if __name__ == '__main__':
+
+    import sys, time
+    from tigkas_bibtexparser import Parser
+
+    if len(sys.argv) < 2:
+        sys.exit('usage: python3 bibtex_reader.py file.bib')
+
+    raw = open(sys.argv[1]).read()
+
+    t = time.time()
+    new = BibtexReader(open(sys.argv[1]))()
+    t_new = time.time() - t
+
+    t = time.time()
+    old = Parser(raw)()
+    t_old = time.time() - t
+
+    print("%s: %.1f MB" % (sys.argv[1], len(raw) / 1e6))
+    print("old parser: %d records in %.2f s" % (len(old), t_old))
+    print("new parser: %d records in %.2f s" % (len(new), t_new))
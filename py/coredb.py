@@ -1,9 +1,10 @@
-import pprint, subprocess, os, glob, shutil
+import subprocess, os, glob, shutil
 from collections import defaultdict
-from utils import locate, validate_bibtex_value
+from utils import locate, validate_bibtex_value, PrefixIndex
 from config import config, expanded_path
 
 from hub import hub, RefdbError, SqliteDB, IntegrityError
+import schema
 
 '''
 keep the basic stuff here - retrieving references, folders etc. The kind
@@ -14,6 +15,28 @@ etc. elsehwere.
 dbfile = os.path.realpath(os.getenv("mbib_db", None) or expanded_path('dbfile'))
 db_template = "resources/default.sqlite"  # relative path of empty db
 
+# connection settings, which can be overridden in the [database] section of the
+# ini file. With the write-ahead log, batch jobs can read the database while the
+# user interface has it open.
+db_pragmas = [
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+    ('cache_size', '-65536'),
+    ('mmap_size', '268435456'),
+    ('temp_store', 'memory'),
+]
+
+def configured_pragmas():
+    pragmas = []
+
+    for name, default in db_pragmas:
+        value = config.get('database', name, fallback=default)
+
+        if value:   # an empty value leaves sqlite's own default in place
+            pragmas.append('%s=%s' % (name, value))
+
+    return pragmas
+
 class RefDb(object):
     """
     implement the database backend for our wonderful urwid GUI
@@ -72,17 +95,27 @@ class RefDb(object):
             else:
                 raise SystemExit("Can find neither %s nor %s" % (dbfile, empty_db))
 
-        elif config['preferences'].getboolean('backup_db_file'):
+        # at this point, the database should be in place
+        hub.register('sqlite', SqliteDB(dbfile, configured_pragmas()))
+        hub.register('dbfile', dbfile)
+
+        self._db = hub.sqlite
+
+        if config['preferences'].getboolean('backup_db_file'):
             backup_db = "%s.bak" % dbfile
 
+            # with a write-ahead log, recent changes may not be in the file itself yet
+            self._db.execute('pragma wal_checkpoint(truncate)').fetchall()
+
             if not os.path.exists(backup_db) or os.stat(backup_db).st_mtime < os.stat(dbfile).st_mtime:
                 shutil.copy(dbfile, backup_db)
+        schema.upgrade(self._db)
 
-        # at this point, the database should be in place
-        hub.register('sqlite', SqliteDB(dbfile))
-        hub.register('dbfile', dbfile)
-
-        self._db = hub.sqlite
+        if config['search'].getboolean('full_text', False):
+            self.full_text = schema.ensure_fts(self._db)
+        else:
+            schema.drop_fts(self._db)
+            self.full_text = False
 
 
     def item_count(self, table):
@@ -96,7 +129,7 @@ class RefDb(object):
         return self.special_branch_nodes.get(node_name, None)
 
 
-    def _prepopulate_cache(self):
+    def _prepopulate_cache(self, ref_ids=None):
         '''
         prepopulate the parent selection cache to avoid hammering the
         db with too many recursive queries. maybe we can use the same
@@ -104,30 +137,38 @@ class RefDb(object):
 
         This would seem innocuous even if we filter folders - the cache
         would just contain invisible items.
+
+        If ref_ids is given, we only refresh the entries for those references;
+        this is what invalidate_refs uses after a change.
         '''
         # first we set all nodes to non-selected
         cache = self.cache['parent_selection']
         node_type = hub.REF
 
-        stmt = 'select ref_id from refs'
-        refs = self._db.execute(stmt).fetchvalues()
+        if ref_ids is None:
+            stmt = 'select ref_id from refs'
+            refs = self._db.execute(stmt, row_dicts=False).fetchvalues()
+            restriction, args = '', []
+        elif len(ref_ids) == 0:
+            return
+        else:
+            refs = ref_ids
+            restriction, args = 'and ref_id in (%s)', [list(ref_ids)]
 
         for ref in refs:
             cache[(node_type, ref)] = 0
 
         # now we overwrite the selected ones
         stmt =  '''
-                with recursive branch_set( i )
-                    as (
-                        select branch_id from branches where selected = 1
-                        union select branch_id from branches, branch_set
-                                where branches.parent_id = branch_set.i
-                    )
-                    select distinct(ref_id) from reflink
-                    where branch_id in branch_set
-                '''
+                select distinct(ref_id) from reflink
+                where branch_id in
+                    ( select descendant_id from branch_closure, branches
+                      where branches.selected = 1
+                      and branch_closure.ancestor_id = branches.branch_id )
+                %s
+                ''' % restriction
 
-        refs = self._db.execute(stmt).fetchvalues()
+        refs = self._db.execute_qmarks(stmt, args, row_dicts=False).fetchvalues()
 
         value = hub.IN_SELECTION
 
@@ -137,22 +178,119 @@ class RefDb(object):
 
     def clear_cache(self):
         """
-        create or reset cache. There must be a better way of doing this
-        than clearing out everything wholesale, but as long as it is
-        fast enough, I will leave it alone.
+        create or reset cache. This throws away everything and should be
+        reserved for genuine full reloads; after changes to individual
+        folders or references, use the invalidate_* methods below instead.
+
+        Besides the cached data themselves, we keep some indexes that record
+        which cached nodes depend on which branch or reference:
+
+        - ref_index: ref_id -> all nodes that display this reference
+        - branch_index: branch_id -> all nodes that represent this branch
+        - child_index: branch_id -> all nodes cached as children of this branch
+
+        child_nodes holds what get_child_nodes returns, together with a dict
+        that maps each child to its position, so that the tree can step from
+        one sibling to the next without searching the list. child_prefixes
+        indexes the same children by key for type-ahead.
         """
         self.cache = dict(
                         parent={},
                         child_branches={},
                         child_references={},
+                        child_nodes={},
+                        child_prefixes={},
                         node_text={},
                         node_selection = {},
                         parent_selection = {},
-                        ref_index=defaultdict(set))
+                        ref_index=defaultdict(set),
+                        branch_index=defaultdict(set),
+                        child_index=defaultdict(set))
 
         self._prepopulate_cache() # this DOES add snappiness.
 
 
+    # the caches that are keyed by node tuples
+    node_caches = 'parent child_branches child_references child_nodes child_prefixes node_text node_selection'.split()
+
+    def _evict(self, keys, caches=node_caches):
+        '''
+        remove the given node keys from the given caches.
+        '''
+        cache = self.cache
+
+        for key in keys:
+            for stuff in caches:
+                cache[stuff].pop(key, None)
+
+
+    def invalidate_nodes(self, nodes):
+        '''
+        forget everything we know about individual nodes, but nothing else.
+        Enough for instance if a reference was selected or deselected.
+        '''
+        self._evict(nodes)
+
+
+    def invalidate_refs(self, ref_ids):
+        '''
+        forget text and selection status of every displayed instance of
+        these references, and work out their parent selection status afresh,
+        all in one go.
+        '''
+        ref_ids = list(ref_ids)
+        cache = self.cache
+
+        for ref_id in ref_ids:
+            self._evict(cache['ref_index'].pop(ref_id, ()), ('node_text', 'node_selection'))
+            cache['parent_selection'].pop((hub.REF, ref_id), None)
+
+        self._prepopulate_cache(ref_ids)
+
+
+    def invalidate_branches(self, branch_ids, recursive=False):
+        '''
+        forget the branches themselves, their contents, and the text, selection
+        and parent links of the nodes cached as their children.
+
+        With recursive=True, we also do this for all folders further down and
+        for the references contained in any of them. Of course, this has to be
+        invoked before any of these folders are deleted; callers that delete
+        stuff should collect the affected ids beforehand (get_nodes_below with
+        ids_only=True) and pass them in explicitly.
+        '''
+        branch_ids = list(branch_ids)
+
+        if not branch_ids:
+            return
+
+        if recursive:
+            below, ref_ids = self.get_nodes_below(branch_ids, ids_only=True)
+            branch_ids += below
+
+        cache = self.cache
+
+        for branch_id in branch_ids:
+            self._evict(cache['branch_index'].pop(branch_id, ()))
+            self._evict(cache['child_index'].pop(branch_id, ()), ('parent', 'node_text', 'node_selection'))
+            cache['parent_selection'].pop((hub.BRANCH, branch_id), None)
+
+        if recursive:
+            self.invalidate_refs(ref_ids)
+
+
+    def invalidate_listings(self):
+        '''
+        forget the contents of all folders, but keep everything else. Needed
+        when the display settings change (sorting, folder filter), but the
+        data stay the same.
+        '''
+        self.cache['child_branches'].clear()
+        self.cache['child_references'].clear()
+        self.cache['child_nodes'].clear()
+        self.cache['child_prefixes'].clear()
+
+
     def refresh_tree_item(self, node, refresh_content=True):
         '''
         let's be a bit more considerate with clearing caches - as long as we
@@ -167,11 +305,11 @@ class RefDb(object):
             cleared.append( cache[stuff].pop(node, None) )
 
         if refresh_content and self.is_branch(node):
-            for stuff in ('child_references', 'child_branches'):
+            for stuff in ('child_references', 'child_branches', 'child_nodes', 'child_prefixes'):
                 cleared.append( cache[stuff].pop(node, None) )
 
         if [i for i in cleared if i is not None]:
-            hub.tree.refresh()
+            hub.refresh_tree()
 
 
     def _reflinked_parents(self, ref_id):
@@ -191,30 +329,24 @@ class RefDb(object):
         '''
         # 1/0 - this is still used after pubmed import for example
         # either leave it in, or make sure to update cache everywhere.
+        #
+        # with the branch_closure table, it has become a plain join.
         stmt =  '''
-                with recursive parent_set(i)
-                    as (
-                        select parent_id
-                        from branches
-                        where branch_id in ( select branch_id from reflink where ref_id=(?) )
-                        union
-                            select parent_id
-                            from branches, parent_set
-                            where branches.branch_id = parent_set.i
-                        )
-                    select * from branches
-                    where branch_id in parent_set
-                    or branch_id in ( select branch_id from reflink where ref_id=(?) )
+                select distinct branches.*
+                from branches, branch_closure, reflink
+                where reflink.ref_id = (?)
+                and branch_closure.descendant_id = reflink.branch_id
+                and branches.branch_id = branch_closure.ancestor_id
                 '''
-        parents = self._db.execute(stmt, [ref_id, ref_id]).fetchall()
+        parents = self._db.execute(stmt, [ref_id]).fetchall()
 
         return parents
 
 
-    def _selection_status(self, node_dict):
+    def _selection_status(self, node_dict, node_type):
         '''
         determine if a node is selected itself, underneath a selected folder,
-        or neither.
+        or neither. node_dict may also be an sqlite3.Row.
 
         Hm. We don't capture cross-listed references. For folders, it is enough
         to just capture the parent folders above this one, but with references
@@ -226,12 +358,9 @@ class RefDb(object):
         # node is not selected itself. work out whether one of its
         # parents is selected.
 
-        node_id = node_dict.get('ref_id', None)
-
-        if node_id is not None:
-            node_type = hub.REF
+        if node_type == hub.REF:
+            node_id = node_dict['ref_id']
         else:
-            node_type = hub.BRANCH
             node_id = node_dict['branch_id']
 
         cache_key = (node_type, node_id)  # branch_ids may be the same numbers as ref_ids,
@@ -264,6 +393,50 @@ class RefDb(object):
         return status
 
 
+    def _fill_parent_selection(self, branch_id, ref_ids=(), child_branch_ids=()):
+        '''
+        work out the parent selection status for all children of one folder
+        at once, so that store doesn't need to query for each of them. We
+        only bother with children not already in the cache.
+
+        - child folders are in a selection if the folder itself or any
+          folder above it is selected; that is the same for all of them.
+        - references are in a selection if any of the folders they are
+          listed in, or any folder above those, is selected.
+        '''
+        cache = self.cache['parent_selection']
+
+        missing = [b for b in child_branch_ids if (hub.BRANCH, b) not in cache]
+
+        if missing:
+            above = self.get_branches_above(branch_id, include_start_branch=True)
+            status = hub.IN_SELECTION if [b for b in above if b['selected']] else 0
+
+            for b in missing:
+                cache[(hub.BRANCH, b)] = status
+
+        missing = [r for r in ref_ids if (hub.REF, r) not in cache]
+
+        if not missing:
+            return
+
+        if self.special_branch_ids.get(branch_id) == 'Trash':
+            selected = set()    # no reflinks, so nothing can be selected
+        else:
+            stmt = '''
+                   select distinct reflink.ref_id
+                   from reflink, branch_closure, branches
+                   where reflink.ref_id in (select ref_id from reflink where branch_id = (?))
+                   and branch_closure.descendant_id = reflink.branch_id
+                   and branches.branch_id = branch_closure.ancestor_id
+                   and branches.selected = 1
+                   '''
+            selected = set(self._db.execute(stmt, [branch_id], row_dicts=False).fetchvalues())
+
+        for r in missing:
+            cache[(hub.REF, r)] = hub.IN_SELECTION if r in selected else 0
+
+
     def store(self, node_dict):
         '''
         store text for each node under a key (class, id, parent) and simply return
@@ -271,21 +444,39 @@ class RefDb(object):
         is unused with branches.
         '''
         # if node_dict is None
+        if node_dict.get('branch_id', None) is not None:  # this is a folder
+            return self.store_branch(node_dict)
+        return self.store_ref(node_dict)
+
+
+    def store_branch(self, node_dict):
+        branch_id = node_dict['branch_id']
         parent_id = node_dict['parent_id']
-        branch_id = node_dict.get('branch_id', None)
+        key = (hub.BRANCH, branch_id, parent_id)
+
+        cache = self.cache
+        cache['branch_index'][branch_id].add(key)
+        cache['child_index'][parent_id].add(key)
+        cache['node_text'][key] = (node_dict['name'], None)
+        cache['node_selection'][key] = self._selection_status(node_dict, hub.BRANCH)
+
+        return key
 
-        if branch_id is not None:  # this is a folder
-            key = (hub.BRANCH, branch_id, parent_id)
-            self.cache['node_text'][key] = (node_dict['name'], None)
-            self.cache['node_selection'][key] = self._selection_status(node_dict)
-            return key
 
+    def store_ref(self, node_dict):
+        '''
+        node_dict may also be an sqlite3.Row with the columns ref_id, parent_id,
+        bibtexkey, title and selected
+        '''
         ref_id = node_dict['ref_id']
+        parent_id = node_dict['parent_id']
         key = (hub.REF, ref_id, parent_id)
 
-        self.cache['ref_index'][ref_id].add(key)
-        self.cache['node_text'][key] = (node_dict['bibtexkey'], node_dict['title'])
-        self.cache['node_selection'][key] = self._selection_status(node_dict)
+        cache = self.cache
+        cache['ref_index'][ref_id].add(key)
+        cache['child_index'][parent_id].add(key)
+        cache['node_text'][key] = (node_dict['bibtexkey'], node_dict['title'])
+        cache['node_selection'][key] = self._selection_status(node_dict, hub.REF)
 
         return key
 
@@ -296,6 +487,8 @@ class RefDb(object):
         refreshing the tree should now be enough.
         '''
         self.branches_only = not self.branches_only
+        self.cache['child_nodes'].clear()
+        self.cache['child_prefixes'].clear()
 
 
     def get_child_nodes(self, branch):
@@ -303,7 +496,7 @@ class RefDb(object):
         return branches and references contained in a single branch.
 
         This is the key entry method that bib.py calls for building
-        the tree.
+        the tree. The list is cached, so callers must not modify it.
         '''
         if self.is_ref(branch):
             return None
@@ -311,13 +504,82 @@ class RefDb(object):
         if not self.is_node(branch):
             branch = self.root_node
 
-        branches = self.get_child_branches(branch)
+        return self._child_listing(branch)[0]
+
+
+    def _child_listing(self, branch):
+        '''
+        the children of branch, and a dict that maps each of them to its index
+        '''
+        listing = self.cache['child_nodes'].get(branch, None)
+
+        if listing is not None:
+            return listing
+
+        children = self.get_child_branches(branch)
+
+        if not self.branches_only:
+            children = children + self.get_child_references(branch)
+
+        positions = { child : i for i, child in enumerate(children) }
+        listing = self.cache['child_nodes'][branch] = (children, positions)
+
+        return listing
+
+
+    def get_siblings(self, node):
+        '''
+        the contents of the folder that node is in, along with the dict that
+        maps each of them to its index. Both come from the cache and must
+        not be modified.
+        '''
+        parent = self.get_parent_node(node)
+
+        if parent is None:
+            return [node], { node : 0 }
+
+        return self._child_listing(parent)
+
+
+    def get_sibling_node(self, node, offset):
+        '''
+        the node offset places after this one in the same folder, or None
+        if there is none. The tree calls this to move up and down.
+        '''
+        siblings, positions = self.get_siblings(node)
+        index = positions.get(node, None)
+
+        if index is None or not 0 <= index + offset < len(siblings):
+            return None
+
+        return siblings[index + offset]
+
+
+    def find_sibling(self, node, prefix, include_self=False):
+        '''
+        the next node after this one in the same folder whose key starts
+        with prefix, wrapping around, or None. With include_self, node
+        itself counts as next. Backend for type-ahead in the tree.
+
+        The index is made when a folder is first searched this way and
+        dropped along with the folder's cached contents.
+        '''
+        siblings, positions = self.get_siblings(node)
+        parent = self.get_parent_node(node)
+        prefixes = self.cache['child_prefixes']
+
+        index = prefixes.get(parent, None)
+
+        if index is None:
+            index = PrefixIndex([self.get_node_text(sibling)[0] for sibling in siblings])
+
+            if parent is not None:
+                prefixes[parent] = index
 
-        if self.branches_only:
-            return branches
+        current = positions.get(node, -1)
+        found = index.next_match(prefix, current - 1 if include_self else current)
 
-        child_references = self.get_child_references(branch)
-        return branches + child_references
+        return None if found is None else siblings[found]
 
 
     def is_node(self, node):
@@ -392,23 +654,20 @@ class RefDb(object):
         '''
         is there a point in returning the complete info? Well, let's
         do it anyway, it is always easy to trim it down.
+
+        The topmost branch comes first.
         '''
         stmt = '''
-        with recursive parent_set(i)
-        as ( select parent_id from branches where branch_id = (?)
-                union select parent_id from branches, parent_set
-                    where branches.branch_id = parent_set.i
-            )
-        select * from branches where branch_id in parent_set
+        select branches.* from branches, branch_closure
+        where branch_closure.descendant_id = (?)
+        and branches.branch_id = branch_closure.ancestor_id
+        and branch_closure.depth >= (?)
+        order by branch_closure.depth desc
         '''
 
-        args = [branch_id]
-
-        if include_start_branch:
-            stmt += "or branch_id = (?)"
-            args.append(branch_id)
+        min_depth = 0 if include_start_branch else 1
 
-        return self._db.execute(stmt, args).fetchall()
+        return self._db.execute(stmt, [branch_id, min_depth]).fetchall()
 
 
     def get_nodes_above(self, node):
@@ -426,15 +685,13 @@ class RefDb(object):
 
     def get_branches_below(self, parent_ids):
         '''
-        recursively find all branches below a parent.
+        find all branches below one or more parents.
         '''
         stmt = '''
-        with recursive branch_set(i)
-        as ( select branch_id from branches where parent_id in (%s)
-                union select branch_id from branches, branch_set
-                    where branches.parent_id = branch_set.i
-            )
-        select * from branches where branch_id in branch_set;
+        select distinct branches.* from branches, branch_closure
+        where branch_closure.ancestor_id in (%s)
+        and branch_closure.depth > 0
+        and branches.branch_id = branch_closure.descendant_id
         '''
 
         return self._db.execute_qmarks(stmt, [parent_ids]).fetchall()
@@ -499,11 +756,11 @@ class RefDb(object):
             return
 
         self.branch_filter_string = search_string
-        hub.clear_cache()
-        hub.tree.refresh()
+        self.invalidate_listings()
+        hub.refresh_tree()
 
         if search_string != '':
-            hub.tree.set_focus(self.special_branch_nodes['References'])
+            hub.focus_node(self.special_branch_nodes['References'])
 
 
     def reset_filter_folders(self):
@@ -605,7 +862,11 @@ class RefDb(object):
         if parent_id is not None:  # Prevent sorting at the top level
             branches.sort(key=lambda b: b['name'].lower())
 
-        branchtuples = self.cache['child_branches'][branch] = [self.store(b) for b in branches]
+        self._fill_parent_selection(branch_id, child_branch_ids=[b['branch_id'] for b in branches])
+
+        branchtuples = self.cache['child_branches'][branch] = [self.store_branch(b) for b in branches]
+        self.cache['branch_index'][branch_id].add(branch)
+        self.cache['parent'].update((b, branch) for b in branchtuples)
 
         return branchtuples
 
@@ -616,8 +877,8 @@ class RefDb(object):
         '''
         self.sort_by_year = not self.sort_by_year
 
-        hub.clear_cache()
-        hub.tree.refresh()
+        self.invalidate_listings()
+        hub.refresh_tree()
 
 
     def get_child_references(self, branch):
@@ -636,13 +897,14 @@ class RefDb(object):
         weg, branch_id, parent_id = branch
         special_name = self.special_branch_ids.get(branch_id, None)
 
+        # listings can be long, so we fetch just the columns we need,
+        # as sqlite3.Row objects rather than dicts
         if special_name == "Trash":
-            stmt = "select * from refs where ref_id not in (select distinct(ref_id) from reflink)"
-            refs = self._db.execute(stmt, []).fetchall()
-
-            for ref in refs:
-                ref['parent_id'] = branch_id
-                ref['selected'] = 0
+            stmt = """
+                   select ref_id, bibtexkey, title, year, (?) as parent_id, 0 as selected
+                   from refs where ref_id not in (select distinct(ref_id) from reflink)
+                   """
+            refs = self._db.execute(stmt, [branch_id], row_dicts=self._db.ROWS).fetchall()
 
         else:
             branch_record = self.get_branch_record(branch_id)
@@ -652,7 +914,10 @@ class RefDb(object):
 
                 stmt = """
                 select
-                    refs.*,
+                    refs.ref_id,
+                    refs.bibtexkey,
+                    refs.title,
+                    refs.year,
                     reflink.branch_id as parent_id,
                     reflink.selected
                 from
@@ -661,11 +926,22 @@ class RefDb(object):
                 where refs.ref_id = reflink.ref_id
                 and reflink.branch_id = (?)
                     """
-                refs = self._db.execute(stmt, [branch_id]).fetchall()
+                refs = self._db.execute(stmt, [branch_id], row_dicts=self._db.ROWS).fetchall()
 
             else:
                 return []
 
+        return self.store_child_references(branch, refs)
+
+
+    def store_child_references(self, branch, refs):
+        '''
+        sort and cache the listing of references in a branch. refs are rows
+        with the columns that get_child_references selects; search uses this
+        to fill in the Search folder from the rows it has just written.
+        '''
+        branch_id = branch[1]
+
         # sort according to user settings
         if not self.sort_by_year:
             sort_key=lambda ref: ref['bibtexkey'].lower()
@@ -673,7 +949,13 @@ class RefDb(object):
             sort_key = lambda ref: ( -int(ref['year']), ref['bibtexkey'].lower() )
 
         refs.sort(key=sort_key)
-        reftuples = self.cache['child_references'][branch] = [self.store(r) for r in refs]
+        self._fill_parent_selection(branch_id, ref_ids=[r['ref_id'] for r in refs])
+
+        reftuples = self.cache['child_references'][branch] = [self.store_ref(r) for r in refs]
+        self.cache['branch_index'][branch_id].add(branch)
+
+        # we know the parent already, which saves a query per reference later on
+        self.cache['parent'].update((ref, branch) for ref in reftuples)
 
         return reftuples
 
@@ -704,6 +986,7 @@ class RefDb(object):
             return None
 
         parent_tuple = self.cache['parent'][node] = self.store(parent)
+        self.cache['child_index'][node[2]].add(node)
         return parent_tuple
 
 
@@ -725,6 +1008,12 @@ class RefDb(object):
         '''
         text = self.get_node_text(key)
         selected = self.cache['node_selection'].get(key, None)
+
+        if selected is None:    # selection status was invalidated, but text was not
+            self.cache['node_text'].pop(key, None)
+            text = self.get_node_text(key)
+            selected = self.cache['node_selection'].get(key, 0)
+
         return text, selected
 
 
@@ -785,11 +1074,13 @@ class RefDb(object):
         create a node object for a bibtexkey to keep
         those methods happy that expect one.
         '''
+        # the same case-insensitive match as 'like', but a straight lookup in
+        # idx_bibtexkey_nocase, and without taking '_' in keys as a wildcard
         stmt = '''
                select reflink.ref_id, reflink.branch_id
                       from refs, reflink
                       where refs.ref_id = reflink.ref_id
-                      and refs.bibtexkey like (?)
+                      and refs.bibtexkey = (?) collate nocase
                       limit 1
                '''
 
@@ -900,7 +1191,7 @@ class RefDb(object):
         I am loath to fire off 3 queries for each reference to be dumped.
         '''
         if history:
-            hub.tree.add_to_history(ref)  # ok, so this works.
+            hub.add_to_history(ref)  # ok, so this works.
 
         base_record = self.get_short_ref(ref)
         extended = self.extend_refs([base_record])[0]
@@ -941,7 +1232,7 @@ class RefDb(object):
         no, we also need the selected status.
         '''
         if ref is None:
-            ref = hub.tree.focus_element()
+            ref = hub.current_node()
 
         node_type, ref_id, branch_id = ref
         assert node_type == hub.REF
@@ -1097,8 +1388,10 @@ class RefDb(object):
             while s:
                 key = s.pop()
                 self.cache['node_text'].pop(key, None)
+                # the bibtexkey may have changed, so the type-ahead index is off
+                self.cache['child_prefixes'].pop(self.get_parent_node(key), None)
 
-            hub.tree.refresh()
+            hub.refresh_tree()
 
         if not add_reference:
             if errors:
@@ -1131,7 +1424,7 @@ class RefDb(object):
 
         # also flush out the old stored text
         self.refresh_tree_item(branch, False)
-        hub.tree.add_to_history(branch)
+        hub.add_to_history(branch)
 
 
     def exists_folder(self, parent, subfolder_name):
@@ -1160,20 +1453,20 @@ class RefDb(object):
         - insert the collect the references back into it.
         '''
         if node is None:    # invocation from menu will trigger this case
-            node = hub.tree.focus_element()
+            node = hub.current_node()
 
         assert hub.is_branch(node)
         node_id = node[1]
 
+        # remember what is going to disappear, for cache invalidation
+        nested_branches, weg = self.get_nodes_below([node_id], ids_only=True)
+
         # collect all references from nested folders
         stmt = '''
-        with recursive branch_set(i)
-        as ( select branch_id from branches where parent_id = (?)
-                union select branch_id from branches, branch_set
-                    where branches.parent_id = branch_set.i
-            )
         select distinct(ref_id) from reflink
-        where branch_id in branch_set
+        where branch_id in
+            ( select descendant_id from branch_closure
+              where ancestor_id = (?) and depth > 0 )
         '''
         nested_references = self._db.execute(stmt, [node_id]).fetchvalues()
 
@@ -1187,13 +1480,14 @@ class RefDb(object):
 
         # finally, insert all references directly into parent, omitting duplicates
         remaining = set(nested_references) -  set(direct_references)
-        for ref in remaining:
-            self._db.insert('reflink', dict(ref_id=ref, branch_id=node_id, selected=0))
+        self._db.insert_rows('reflink', ('ref_id', 'branch_id', 'selected'),
+                             [(ref, node_id, 0) for ref in remaining])
 
         # finish up
         self._db.commit()
-        hub.clear_cache()
-        hub.tree.refresh()
+        self.invalidate_branches([node_id] + nested_branches)
+        self.invalidate_refs(nested_references)
+        hub.refresh_tree()
 
 
 
@@ -1216,7 +1510,14 @@ _export = '''
           get_node_text
           get_nodes_above
           get_parent_node
+          get_sibling_node
+          get_siblings
+          find_sibling
           get_ref_dict
+          invalidate_branches
+          invalidate_listings
+          invalidate_nodes
+          invalidate_refs
           node_for_bibtexkey
           is_branch
           is_ref
@@ -56,7 +56,8 @@ class ErrorDialog(dialog.MessageBox):
     outer_height = 10
 
 
-hub.register('show_errors', lambda errors, *a, **kw: ErrorDialog(errors, *a, **kw).show())
+hub.subscribe('errors', lambda errors, *a, **kw: ErrorDialog(errors, *a, **kw).show())
+hub.subscribe('message', lambda message: dialog.MessageBox(message).show())
 
 
 class InfoDialog(ErrorDialog):
@@ -3,8 +3,8 @@ The hub class is instantiated only once. This instance is sort of an
 'explicit global namespace' within which other modules register exported
 functions or objects.
 '''
-from collections import OrderedDict
-from urwidtools import dialog
+import importlib, importlib.util
+from collections import OrderedDict, defaultdict
 
 from SqliteDB import SqliteDB, IntegrityError
 from config import config
@@ -59,6 +59,8 @@ class hub(object):
     def __init__(self):
         self.is_batch = True   #  default - gets switched in mbib.py if not in batch mode
         self._registry = {}
+        self._providers = {}    # name -> module that will register it once imported
+        self._listeners = defaultdict(list)
 
         # create key bindings from the config file
         self.actions = OrderedDict()
@@ -103,8 +105,39 @@ class hub(object):
 
 
     def __getattr__(self, att):
+        try:
+            return self._registry[att]
+        except KeyError:
+            if att.startswith('__'):
+                raise
+
+        self._load_providers(att)
         return self._registry[att]
 
+    def _load_providers(self, att=None):
+        '''
+        import the module that provides att. If we haven't been told of one,
+        import all that are still pending, since the names given to .provide
+        might have fallen behind a module's _export list.
+        '''
+        if att is not None and att in self._providers:
+            module_names = [self._providers[att]]
+        else:
+            module_names = sorted(set(self._providers.values()))
+
+        for module_name in module_names:
+            # forget the module first, so that lookups during its import don't recurse
+            self._providers = { k : v for k, v in self._providers.items() if v != module_name }
+            importlib.import_module(module_name)
+
+    def provide(self, module_name, names):
+        '''
+        announce the names that a module registers, but import it only once
+        one of them is looked up. This keeps startup quick.
+        '''
+        for name in names.split():
+            self._providers[name] = module_name
+
     def register(self, name, obj):
         self._registry[name] = obj
 
@@ -112,14 +145,51 @@ class hub(object):
         for name in namelist:
             self.register(name, getattr(obj, name))
 
-    # some simple methods can be implemented right here; that doesn't hurt anything.
+    def subscribe(self, event, callback):
+        '''
+        have callback invoked whenever event is announced. The database code
+        announces what the user should see - errors, messages, tree changes -
+        and leaves it to whoever listens to show it. Without the user interface,
+        nobody may be listening, and that is fine.
+        '''
+        self._listeners[event].append(callback)
+
+    def unsubscribe(self, event, callback):
+        self._listeners[event].remove(callback)
+
+    def announce(self, event, *a, **kw):
+        for callback in list(self._listeners[event]):
+            callback(*a, **kw)
+
+    # the core modules talk to the user interface only through the methods below.
+    def show_errors(self, errors, **kw):
+        self.announce('errors', errors, **kw)
+
     def show_message(self, message):
+        self.announce('message', message)
+
+    def set_status_bar(self, *a):
+        self.announce('status', *a)
+
+    def refresh_tree(self):
+        self.announce('refresh_tree')
+
+    def focus_node(self, node):
+        self.announce('focus_node', node)
+
+    def add_to_history(self, node):
+        self.announce('add_to_history', node)
+
+    def current_node(self):
         '''
-        we disable messages if we are in batch mode, so that
-        client code doesn't have to worry
+        the node in focus in the tree. Code that may run without the user
+        interface must pass its nodes explicitly.
         '''
-        if not self.is_batch:
-            dialog.MessageBox(message).show()
+        try:
+            focus_element = self._registry['focus_element']
+        except KeyError:
+            raise RefdbError('no node given, and no tree to take it from')
+        return focus_element()
 
 
     def progress_bar(self, target, **kw):
@@ -130,14 +200,10 @@ class hub(object):
         if self.is_batch:
             return Null()
         else:
+            from urwidtools import dialog
             return dialog.ProgressBar(target, **kw)
 
 
-    def set_status_bar(self, *a, **kw):
-        if not self.is_batch:
-            self.app.set_status(*a, **kw)
-
-
     def process_action(self, action):
         '''
         this is the main entry point for processing function keys and keyboard shortcuts.
@@ -172,15 +238,71 @@ class hub(object):
 
 hub = hub()
 
-# I guess the sequence of imports still matters ... no?
-import help4mbib, ui, coredb, selections, trashcan, imex, search, editor_push
-
-try:
-    import mbiboo
-    hub.uno = True
-except ImportError:
-    hub.uno = False
+# coredb is needed right away; the other modules are imported on first use of
+# one of their exports. Keep the names below in step with their _export lists.
+# The user interface modules help4mbib and ui are imported by bibapp, so that
+# batch jobs and other scripts can use the database without urwid.
+import coredb
+
+hub.provide('selections', '''
+          add_folder
+          copy_selected
+          count_selected_items
+          delete_selected
+          deselect_all
+          get_selected_bibtexkeys
+          get_selected_refs
+          get_selected_refs_full
+          mail_current
+          mail_selected
+          move_selected
+          ref_xsel
+          select_refs
+          toggle_select
+          xsel_selected
+          ''')
+
+hub.provide('trashcan', '''
+          delete_node
+          delete_other_instances
+          erase_node
+          empty_recycled
+          _empty_folder
+          empty_trash
+          recycle_trash
+          ''')
+
+hub.provide('imex', '''
+          add_reference
+          clear_recent
+          export_bibtex
+          export_html
+          import_pubmed
+          import_bibtex
+          import_doi
+          ''')
+
+hub.provide('search', '''
+          search_references
+          saved_search
+          reset_search
+          ''')
+
+hub.provide('editor_push', '''
+          cite_selected_latex
+          cite_current_latex
+          ''')
+
+# importing uno takes a while, so we only check that it is there
+hub.uno = importlib.util.find_spec('uno') is not None
+
+if hub.uno:
+    hub.provide('mbiboo', '''
+          oo_cite
+          cite_by_key
+          cite_selected_oo
+          ''')
+else:
     print("uno not found - starting without OpenOffice interaction")
-    for key in "oc":
-        hub.actions.pop(key)
-
+    for action in ('cite_key_input', 'cite_selected_oo'):
+        hub.actions.pop(hub.keys.pop(action, None), None)
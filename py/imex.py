@@ -4,25 +4,23 @@ import export
 I guess it would be good to export the tree structure to JabRef as well. This would
 help with navigation inside JabRef. IIRC we already had this working.
 '''
-import re, string, pprint, os, traceback, textwrap
+import re, string, os, traceback, textwrap, hashlib
 #from unidecode import unidecode
 
-from pubmed_retrieval import PubmedImporter, PubmedError
-from tigkas_bibtexparser import Parser as BibtexParser
+from bibtex_reader import BibtexReader, BibtexError
 from hub import hub, RefdbError, IntegrityError
-from html_formatter import OlFormatter, DlFormatter
-from urwidtools import dialog
 from AsciiDammit3 import asciiDammit
-from urllib.request import Request, urlopen
 
 from config import config
-from utils import writefile
+from utils import writefile, with_retries, map_concurrently, validate_bibtex_value, SortedKeys
 
 class Imex(object):
 
     name_re = re.compile('[A-Za-z\.]+')
 
     key_width = 12
+    export_chunk_size = 500     # records fetched from the database at a time when exporting
+    doi_base_url = 'http://dx.doi.org/'
     field_template = "    %s = {%s},"
     value_indent = " " * 20 # match position of first brace
 
@@ -43,6 +41,16 @@ class Imex(object):
         self.export_wrapped = config['bibtex'].getboolean('export_wrapped')
         self.standardize_key = config['bibtex'].getboolean('standardize_key')
         self.ascii_key = config['bibtex'].getboolean('ascii_key')
+        self.bibtex_format = self.format_signature()
+
+        self.net_threads = config.getint('network', 'threads', fallback=8)
+        self.net_timeout = config.getfloat('network', 'timeout', fallback=20)
+        self.net_retries = config.getint('network', 'retries', fallback=2)
+        self.net_backoff = config.getfloat('network', 'backoff', fallback=1)
+
+        # kept after a partial failure, so that importing the same pmids
+        # again fetches only what is still missing
+        self._pubmed_importer = None
 
 
     def __getattr__(self, att):
@@ -56,27 +64,144 @@ class Imex(object):
         hub._empty_folder(self.recently_added_id)
 
 
+    def _check_new_record(self, data):
+        '''
+        the rules every new reference has to pass, whether it comes from the
+        add reference dialog or from an import. Returns the cleaned up data
+        and a list of errors. Empty values are left out, and so are values
+        with unbalanced braces; title and reftype get stand-ins if needed.
+        '''
+        errors = []
+        data = { k : str(v).strip() for k, v in data.items() if v is not None }
+        data = { k : v for k, v in data.items() if v }
+
+        for key, value in list(data.items()):
+            if key != 'title' and not validate_bibtex_value(value):
+                errors.append("unbalanced braces in field %s" % key)
+                del data[key]
+
+        data['title'] = data.get('title', '').rstrip('.')
+
+        if not data['title']:
+            data['title'] = "Title can't be empty -- please fix"
+            errors.append(data['title'])
+
+        if data.get('reftype') not in self.ref_types:
+            errors.append("reftype was empty or faulty - set to 'article'")
+            data['reftype'] = 'article'
+
+        return data, errors
+
+
+    def _prepare_record(self, data, ref_id, key_index, existing_ids):
+        '''
+        check one imported record and turn it into rows for refs, uniqid,
+        optional and reflink, keyed by table. Nothing touches the database.
+        Returns the rows and errors; the rows are None if the record has to
+        be dropped.
+        '''
+        data, errors = self._check_new_record(data)
+        title = data['title']
+
+        uniq = [(self.field_types[f], data[f]) for f in self.uniqids if f in data]
+
+        if any(u in existing_ids for u in uniq):
+            errors.append("Record '%s...' not imported (likely duplicate)" % title[:50])
+            return None, errors
+
+        existing_ids.update(uniq)
+
+        bibtexkey = self.make_bibtex_key(data, key_index)
+        key_index.add(bibtexkey)
+
+        rows = dict(refs=[(ref_id, self.ref_types[data['reftype']], bibtexkey, title, data.get('year', 0))],
+                    uniqid=[], optional=[], reflink=[])
+
+        for key, value in data.items():
+            if key in ('reftype', 'bibtexkey', 'title', 'year') or key not in self.field_types:
+                continue
+
+            table_name = 'uniqid' if key in self.uniqids else 'optional'
+            rows[table_name].append((ref_id, self.field_types[key], value))
+
+        return rows, errors
+
+
+    _import_columns = [
+        ('refs', ('ref_id', 'reftype_id', 'bibtexkey', 'title', 'year')),
+        ('uniqid', ('ref_id', 'field_id', 'content')),
+        ('optional', ('ref_id', 'field_id', 'content')),
+        ('reflink', ('ref_id', 'branch_id')),
+    ]
+
+    def _insert_prepared(self, prepared):
+        '''
+        insert the rows of prepared records with one executemany per table
+        '''
+        for table, columns in self._import_columns:
+            self._db.insert_rows(table, columns, [row for rows in prepared for row in rows[table]])
+
+
     def _import_records(self, node, records):
         '''
         shared backend for insertion of references retrieved from
         pubmed or parsed from bibtex
+
+        All records are checked in memory first - bibtex keys and unique
+        identifiers against indexes loaded once up front - and then inserted
+        with one executemany per table and a single commit. Adding them one
+        by one through add_reference takes minutes for large imports.
         '''
         errors = []
 
+        # new references get ids above this one; we need them for cache invalidation
+        last_ref_id = self._db.execute('select max(ref_id) from refs').fetchvalue() or 0
+
+        key_index = SortedKeys(self._db.execute('select bibtexkey from refs', row_dicts=False).fetchvalues())
+        existing_ids = set(self._db.execute('select field_id, content from uniqid', row_dicts=False).fetchall())
+
         progress_bar = hub.progress_bar(target=len(records), title="Adding references to database")
         progress_bar.show()
 
+        prepared = []
+        next_ref_id = last_ref_id + 1
+
         for i, record in enumerate(records):
-            more_errors = self.add_reference(record, node, single_mode=False)
+            rows, more_errors = self._prepare_record(record, next_ref_id, key_index, existing_ids)
             errors.extend(more_errors)
             progress_bar.update(i+1)
 
+            if rows is None:
+                continue
+
+            for branch_id in (node[1], self.recently_added_id):
+                rows['reflink'].append((next_ref_id, branch_id))
+
+            prepared.append(rows)
+            next_ref_id += 1
+
+        progress_bar.dismiss()
+
+        try:
+            self._insert_prepared(prepared)
+        except IntegrityError:
+            # something got past the checks. Go through the records one at a
+            # time, so that only the offending ones are left out.
+            self._db.rollback()
+            errors.extend(self._insert_one_by_one(prepared))
+        except:
+            self._db.rollback()
+            raise
+
         self._db.commit()
 
-        # hub.refresh_tree_item(node)
         # we need to refresh the tree in order to update the Imported pseudo-folder
-        hub.clear_cache()
-        hub.tree.refresh()
+        stmt = 'select ref_id from refs where ref_id > (?)'
+        new_ref_ids = self._db.execute(stmt, [last_ref_id]).fetchvalues()
+
+        self.invalidate_branches([node[1], self.recently_added_id])
+        self.invalidate_refs(new_ref_ids)
+        hub.refresh_tree()
 
         if len(errors):
             hub.show_errors(errors)
@@ -87,6 +212,36 @@ class Imex(object):
         hub.set_status_bar('Imported %s reference%s' % (refs_imported, suffix))
 
 
+    def _insert_one_by_one(self, prepared):
+        '''
+        fallback for _import_records. Returns errors for the records that
+        couldn't be inserted.
+        '''
+        errors = []
+
+        # the outer savepoint keeps it all in one transaction
+        self._db.execute('savepoint import_records')
+
+        try:
+            for rows in prepared:
+                self._db.execute('savepoint import_record')
+
+                try:
+                    self._insert_prepared([rows])
+                except IntegrityError as e:
+                    self._db.execute('rollback to import_record')
+                    title = rows['refs'][0][3]
+                    errors.append("Record '%s...' not imported (%s)" % (title[:50], e))
+
+                self._db.execute('release import_record')
+        except:
+            self._db.rollback()
+            raise
+
+        self._db.execute('release import_records')
+        return errors
+
+
     def _file_or_text(self, raw_info):
         '''
         try to open as file, if it fails, return text
@@ -106,16 +261,29 @@ class Imex(object):
         How much of this code can we reuse for importing BibTex?
         The tail end.
         '''
+        from pubmed_retrieval import PubmedImporter, PubmedError
+
         raw_ids = self._file_or_text(raw_info)
 
         self.ref_count_before = self.item_count('refs')
 
+        importer = None
+
         try:
             importer = PubmedImporter(raw_ids)
+
+            previous = self._pubmed_importer
+            if previous is not None and previous.pmid_list == importer.pmid_list:
+                importer = previous
+
+            self._pubmed_importer = importer
             records, failed_pmids = importer()
         except PubmedError as e:
-            hub.show_errors(e.message)
+            hub.show_errors(str(e))
             return
+        finally:
+            if not (importer and importer.pending):
+                self._pubmed_importer = None
 
         if len(failed_pmids):
             msg = 'nothing retrieved for the following identifiers: %s' % ', '.join(failed_pmids)
@@ -130,15 +298,20 @@ class Imex(object):
 
         raw_info could be a file name or bibtex text
         '''
-        raw_bibtex = self._file_or_text(raw_info)
+        # files are read piecemeal rather than slurped
+        try:
+            source = open(raw_info)
+        except (FileNotFoundError, OSError): # OSError can happen on long file names
+            source = raw_info
 
         try:
-            p = BibtexParser(raw_bibtex)
-            records = p()
-        except Exception as e:
-            raise
-            hub.show_errors(getattr(e, 'message', 'bibtexparser foobared'))
+            records = BibtexReader(source)()
+        except BibtexError as e:
+            hub.show_errors(str(e))
             return
+        finally:
+            if source is not raw_info:
+                source.close()
 
         if len(records) == 0:
             msg = 'No records recognized in input'
@@ -159,10 +332,13 @@ class Imex(object):
         return str(uuid4()).replace('-','')[:length]
 
 
-    def make_bibtex_key(self, data):
+    def make_bibtex_key(self, data, key_index=None):
         '''
         if bibtexkey is faulty, missing, or discarded according to
         ini-file preference, concoct a new one.
+
+        key_index may be a SortedKeys instance holding all keys in the
+        database, which saves a query per record during imports.
         '''
         if not self.standardize_key:
             btk = data.get('bibtexkey', None)
@@ -193,8 +369,12 @@ class Imex(object):
         if self.ascii_key:
             btk = asciiDammit(btk)  # remove accented characters - hard to type on English keyboards
 
-        stmt = 'select bibtexkey from refs where bibtexkey like (?)'
-        existing_keys = self._db.execute(stmt, [btk + '%']).fetchvalues()
+        if key_index is None:
+            # idx_bibtexkey_nocase lets sqlite answer this from the index
+            stmt = 'select bibtexkey from refs where bibtexkey like (?)'
+            existing_keys = set(self._db.execute(stmt, [btk + '%']).fetchvalues())
+        else:
+            existing_keys = set(key_index.with_prefix(btk))
 
         suffixes = [''] + list(string.ascii_lowercase)
 
@@ -205,7 +385,11 @@ class Imex(object):
                 return test_key
 
         # if we get here, we have a REALLY common name ... more Chin's than a Singapore phone book ...
-        return '%s-%s' % (btk, self.random_string(4))
+        while True:
+            test_key = '%s-%s' % (btk, self.random_string(4))
+
+            if not test_key in existing_keys:
+                return test_key
 
 
     def add_reference(self, new_data, node=None, single_mode=True):
@@ -218,7 +402,7 @@ class Imex(object):
         don't commit and display errors right here in that case.
         '''
         if node is None:
-            node = hub.tree.focus_element()
+            node = hub.current_node()
         assert hub.is_branch(node)
 
         values = [_f for _f in list(new_data.values()) if _f]
@@ -229,7 +413,7 @@ class Imex(object):
 
         # I guess from here we will insert something, even if it is crap.
         # we just keep track of the errors and show them at the end.
-        errors = []
+        new_data, errors = self._check_new_record(new_data)
 
         orig_bibtexkey = new_data.get('bibtexkey')
         new_bibtexkey = new_data['bibtexkey'] = self.make_bibtex_key(new_data)
@@ -237,16 +421,6 @@ class Imex(object):
         #if orig_bibtexkey and orig_bibtexkey != new_bibtexkey: don't nag the user
             #hub.show_message("bibtexkey '%s' changed to '%s'" % (orig_bibtexkey, new_bibtexkey))
 
-        new_data['title'] = new_data['title'].rstrip('.')
-
-        if not new_data['title']:
-            new_data['title'] = "Title can't be empty -- please fix"
-            errors.append(new_data['title'])
-
-        if new_data['reftype'] not in self.ref_types:
-            errors.append("reftype was empty or faulty - set to 'article'")
-            new_data['reftype'] = 'article'
-
         # at this point, we should have everything in place. Now, we can still fail to
         # insert a reference if we have a duplicate bibtexkey, in which case we need to fix.
         # I suppose I will fix it up with appending a short random string.
@@ -295,6 +469,16 @@ class Imex(object):
         return self.field_template % (key.ljust(self.key_width), value)
 
 
+    def format_signature(self):
+        '''
+        a short fingerprint of everything that goes into format_bibtex. Cached
+        output made with different settings doesn't count.
+        '''
+        settings = [config['bibtex']['export_fields'].strip(), self.export_wrapped,
+                    self.key_width, self.field_template, self.bibtex_wrapper.width]
+        return hashlib.sha1(repr(settings).encode()).hexdigest()[:16]
+
+
     def format_bibtex(self, data):
         '''
         take a data dict and spit it out as formatted bibtex.
@@ -360,9 +544,151 @@ class Imex(object):
         return sorted(records, key=lambda r: r['bibtexkey']) # sorting could be made configurable
 
 
+    def get_export_ids(self, node=None, folder_ids=None, ref_keys=None):
+        '''
+        like get_export_records, but return only the ref_ids, sorted by bibtexkey,
+        so that the records themselves can be fetched and formatted piecemeal.
+        '''
+        if node is not None:
+            if hub.is_ref(node):
+                return [node[1]]
+            folder_ids = [node[1]]
+
+        if folder_ids is not None:
+            stmt = '''
+                   select distinct refs.ref_id from refs, reflink, branch_closure
+                   where branch_closure.ancestor_id in (%s)
+                   and reflink.branch_id = branch_closure.descendant_id
+                   and refs.ref_id = reflink.ref_id
+                   order by refs.bibtexkey
+                   '''
+            return self._db.execute_qmarks(stmt, [folder_ids]).fetchvalues()
+
+        if ref_keys is not None:
+            stmt = 'select ref_id from refs where bibtexkey in (%s) order by bibtexkey'
+            values = list(ref_keys)
+        else:  # get current selection
+            stmt = 'select ref_id from refs where ref_id in (%s) order by bibtexkey'
+            values = list(set(r[0] for r in hub.get_selected_refs()))
+
+        if not values:
+            return []
+
+        return self._db.execute_qmarks(stmt, [values]).fetchvalues()
+
+
+    def iter_export_records(self, ref_ids):
+        '''
+        yield full records for ref_ids, in the given order. We only ever
+        hold export_chunk_size of them in memory.
+        '''
+        stmt = """
+            select
+                refs.*,
+                reftypes.name as reftype
+            from
+                refs,
+                reftypes
+            where
+                refs.ref_id in (%s)
+                and refs.reftype_id = reftypes.reftype_id
+            """
+        size = self.export_chunk_size
+
+        for start in range(0, len(ref_ids), size):
+            chunk = ref_ids[start:start+size]
+            base_records = self._db.execute_qmarks(stmt, [chunk]).fetchall()
+            lookup = { r['ref_id'] : r for r in self.extend_refs(base_records) }
+
+            for ref_id in chunk:
+                yield lookup[ref_id]
+
+
+    def _store_bibtex(self, rows):
+        '''
+        write (ref_id, revision, format, content) rows to bibtex_cache in a
+        transaction of their own
+        '''
+        columns = ('ref_id', 'revision', 'format', 'content')
+
+        try:
+            self._db.insert_rows('bibtex_cache', columns, rows, verb='insert or replace')
+        except:
+            self._db.rollback()
+            raise
+
+        self._db.commit()
+
+
+    def iter_bibtex(self, ref_ids, progress_bar=None):
+        '''
+        format records one by one, for writing to a file as we go.
+
+        Formatted records are kept in bibtex_cache, stamped with the revision of
+        the reference. Only records that have changed since they were last
+        exported are fetched and formatted again. The new cache entries of each
+        chunk are written once all its records have been handed out, each chunk
+        in a short transaction of its own, so that the export doesn't hold the
+        write lock while the file is being written, and memory use stays flat.
+        '''
+        stmt = '''
+               select refs.ref_id, bibtex_cache.content
+               from refs, bibtex_cache
+               where refs.ref_id in (%s)
+               and bibtex_cache.ref_id = refs.ref_id
+               and bibtex_cache.revision = refs.revision
+               and bibtex_cache.format = (%s)
+               '''
+        size = self.export_chunk_size
+        done = 0
+
+        for start in range(0, len(ref_ids), size):
+            chunk = ref_ids[start:start+size]
+            rows = self._db.execute_qmarks(stmt, [chunk, [self.bibtex_format]], row_dicts=False)
+            cached = dict(rows.fetchall())
+
+            stale = [ref_id for ref_id in chunk if ref_id not in cached]
+            fresh = {}
+            store = []      # (ref_id, revision, format, content)
+
+            for record in self.iter_export_records(stale):
+                fresh[record['ref_id']] = content = self.format_bibtex(record)
+                store.append((record['ref_id'], record['revision'], self.bibtex_format, content))
+
+            for ref_id in chunk:
+                yield ('\n\n' if done else '') + (cached.get(ref_id) or fresh[ref_id])
+                done += 1
+
+                if progress_bar is not None:
+                    progress_bar.update(done)
+
+            if store:
+                self._store_bibtex(store)
+
+
+    def export_digest(self, ref_ids):
+        '''
+        fingerprint of what exporting ref_ids would produce: the records, in
+        order, at their current revisions, and the output format.
+        '''
+        stmt = 'select ref_id, revision from refs where ref_id in (%s)'
+        digest = hashlib.sha1(self.bibtex_format.encode())
+        size = self.export_chunk_size
+
+        for start in range(0, len(ref_ids), size):
+            chunk = ref_ids[start:start+size]
+            revisions = dict(self._db.execute_qmarks(stmt, [chunk], row_dicts=False).fetchall())
+
+            for ref_id in chunk:
+                digest.update(b'%d:%d;' % (ref_id, revisions[ref_id]))
+
+        return digest.hexdigest()
+
+
     def write_export_records(self, output, file_name, batch):
         '''
-        write formatted records to file. backend for both bibtex and html
+        write formatted records to file. backend for both bibtex and html.
+        output can be a string or an iterable of strings.
         '''
         try:
             rv = writefile(file_name, output)
@@ -375,25 +701,24 @@ class Imex(object):
             # hub.show_info("File %s written" % file_name)
             if not batch:
                 hub.set_status_bar("Output sent to %s" % rv)
+            return rv
 
 
     def export_bibtex(self, node=None, folder_ids=None, ref_keys=None, file_name=None, batch=False):
         '''
         export records in bibtex format. Since this is a little slow
         with large numbers of records, we show a progress bar.
+
+        Records are fetched, formatted and written in chunks, so that memory
+        use stays flat even when exporting the entire database.
         '''
-        records = self.get_export_records(node=node, folder_ids=folder_ids, ref_keys=ref_keys)
-        output = []
+        ref_ids = self.get_export_ids(node=node, folder_ids=folder_ids, ref_keys=ref_keys)
 
-        progress_bar = hub.progress_bar(len(records), title="exporting to BibTex", interval=10)
+        progress_bar = hub.progress_bar(len(ref_ids), title="exporting to BibTex", interval=10)
         progress_bar.show()
 
-        for i, record in enumerate(records):
-            output.append(self.format_bibtex(record))
-            progress_bar.update(i+1)
-
-        output = '\n\n'.join(output)
-        self.write_export_records(output, file_name, batch)
+        output = self.iter_bibtex(ref_ids, progress_bar)
+        return self.write_export_records(output, file_name, batch)
 
 
     def export_html(self, node=None, file_name=None, batch=False):
@@ -401,6 +726,8 @@ class Imex(object):
         export records as html. Maybe we should update this to
         accepting nodelist rather than a single node also.
         '''
+        from html_formatter import OlFormatter, DlFormatter     # latex2html is a heavy import
+
         records = self.get_export_records(node=node)
         fmt = config['html']['list_format']
         sort_key = config['html']['sort_key']
@@ -422,16 +749,37 @@ class Imex(object):
         '''
         fetch bibtex for a single doi. Error handling goes above.
         '''
-        q = Request('http://dx.doi.org/' + doi)
+        from urllib.request import Request, urlopen     # a heavy import
+
+        q = Request(self.doi_base_url + doi)
         q.add_header('Accept', 'text/bibliography; style=bibtex')
-        a = urlopen(q).read().strip()
+        a = urlopen(q, timeout=self.net_timeout).read().strip()
         return a.decode('UTF-8','ignore').replace('–','-')
 
 
+    def _fetch_doi_retrying(self, doi):
+        '''
+        retry failed lookups, except when the server tells us that the doi
+        doesn't exist or the request is malformed.
+        '''
+        from urllib.error import HTTPError
+
+        give_up = lambda error: isinstance(error, HTTPError) \
+                                and 400 <= error.code < 500 and error.code not in (408, 429)
+
+        return with_retries(lambda: self._fetch_bibtex_for_doi(doi),
+                            retries=self.net_retries,
+                            backoff=self.net_backoff,
+                            give_up=give_up)
+
+
     def import_doi(self, node, raw_info):
         '''
         convert a doi to bibtex first, and then import that. should we allow multiple dois?
         why not - let's just split across whitespace.
+
+        The dois are looked up concurrently, since most of the time is spent
+        waiting for doi.org.
         '''
         doi = self._file_or_text(raw_info)
         dois = doi.split()
@@ -440,20 +788,13 @@ class Imex(object):
         progress_bar = hub.progress_bar(l, title="fetching %s record(s) from doi.org" % l)
         progress_bar.show()
 
-        records = []
-        failed_dois = []
-
-        for i, doi in enumerate(dois):
-            progress_bar.update(i+1)
-
-            try:
-                bibtex = self._fetch_bibtex_for_doi(doi)
-                records.append(bibtex)
-            except:
-                failed_dois.append(doi)
+        results = map_concurrently(self._fetch_doi_retrying, dois, self.net_threads, progress_bar)
 
         progress_bar.dismiss()
 
+        records = [bibtex for doi, bibtex, error in results if error is None]
+        failed_dois = [doi for doi, bibtex, error in results if error is not None]
+
         if len(failed_dois):
             msg = 'retrieval failed for the following identifiers: %s' % ', '.join(failed_dois)
             hub.show_errors(msg)
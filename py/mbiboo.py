@@ -152,14 +152,14 @@ class LibreOffice(object):
         insert a single reference into openoffice
         '''
         if node is None:
-            node = hub.tree.focus_element()
+            node = hub.current_node()
 
         assert hub.is_ref(node)
 
         raw_data = self.get_ref_dict(node)
 
         adapted = {}
-        junk = "branches abstract selected pmid reftype_id purpose ref_id"
+        junk = "branches abstract selected pmid reftype_id purpose ref_id revision"
 
         for key, value in raw_data.items():
             if key in junk:
@@ -4,10 +4,16 @@ OK doke, we are going to redo this using efetch and lxml:
 - unicode, not ascii
 - more straightforward parsing. The old medline-text based version
   is in folder 'old'.
+
+Large lists of ids are fetched in chunks, several at a time but within
+pubmed's rate limit. A chunk that fails doesn't spoil the others, and
+calling the importer again fetches only the chunks still missing and returns
+just the records from those.
 '''
 import re, pprint
-from io import BytesIO
 from hub import hub
+from config import config
+from utils import with_retries, map_concurrently, RateLimiter
 
 class PubmedError(Exception):
     pass
@@ -53,28 +59,54 @@ class PubmedImporter(object):
             raise PubmedError('no valid pmid identifiers (pmids are just numbers)')
 
         self.failed_pmids = set(self.pmid_list)     #   we strike off every pmid that we do retrieve
-        self.records = []
 
+        size = config.getint('network', 'pubmed_chunk_size', fallback=200)
+        self.chunks = [self.pmid_list[i:i+size] for i in range(0, len(self.pmid_list), size)]
+        self.pending = list(range(len(self.chunks)))    # indexes of chunks not yet retrieved
+
+        self.threads = config.getint('network', 'threads', fallback=8)
+        self.timeout = config.getfloat('network', 'timeout', fallback=20)
+        self.retries = config.getint('network', 'retries', fallback=2)
+        self.backoff = config.getfloat('network', 'backoff', fallback=1)
+        self.rate_limit = RateLimiter(config.getfloat('network', 'pubmed_rate', fallback=3))
 
-    def fetch(self):
+
+    def fetch(self, pmids):
         '''
-        get the raw stuff from pubmed
+        get the raw stuff from pubmed for one chunk of pmids
         '''
         import requests         # a heavy import
-        progress_bar = hub.progress_bar(target=len(self.pmid_list), title="Fetching Pubmed records")
-        progress_bar.show()
 
-        parameters = dict(db="pubmed", retmode="xml", id=','.join(self.pmid_list))
+        parameters = dict(db="pubmed", retmode="xml", id=','.join(pmids))
 
-        try:
-            r = requests.post(url=self.efetch_base_url, data=parameters, allow_redirects=True)
-            webfile = BytesIO(r.content)
-        except:
-            raise PubmedError('Nothing retrieved for given identifiers')
-        finally:
-            progress_bar.dismiss()
+        def post():
+            self.rate_limit.wait()
+            r = requests.post(url=self.efetch_base_url, data=parameters,
+                              allow_redirects=True, timeout=self.timeout)
+            r.raise_for_status()
+            return r.content
+
+        return with_retries(post, retries=self.retries, backoff=self.backoff)
+
+
+    def parse(self, content):
+        '''
+        parse the articles of one chunk. The response is in memory anyway,
+        and a chunk is small enough to parse in one go.
+        '''
+        from lxml import etree      # a heavy import
+
+        root = etree.fromstring(content)
 
-        return webfile
+        for article in root.iter('PubmedArticle'):
+            yield self.parse_article(article)
+
+
+    def fetch_chunk(self, index):
+        '''
+        fetch and parse one chunk. Runs in a worker thread.
+        '''
+        return list(self.parse(self.fetch(self.chunks[index])))
 
 
     def bibtex_escape(self, text):
@@ -166,24 +198,35 @@ class PubmedImporter(object):
 
     def __call__(self):
         '''
-        fetch, parse, return. update progress bar if present.
+        fetch, parse, return. update progress bar if present. Only the records
+        from chunks retrieved in this call are returned.
         '''
-        from lxml import etree      # a heavy import
+        progress_bar = hub.progress_bar(target=len(self.pending), title="Fetching Pubmed records")
+        progress_bar.show()
+
+        try:
+            results = map_concurrently(self.fetch_chunk, self.pending, self.threads, progress_bar)
+        finally:
+            progress_bar.dismiss()
 
-        webfile = self.fetch()
-        root = etree.parse(webfile)
-        articles = root.findall('PubmedArticle')
+        records = []
+        retrieved = 0
 
-        progress_bar = hub.progress_bar(target=len(articles), title="Parsing records")
-        progress_bar.show()
+        for index, chunk_records, error in results:
+            if error is not None:
+                continue
 
-        for i, article in enumerate(articles):
-            parsed = self.parse_article(article)
-            self.records.append(parsed)
-            self.failed_pmids.discard(parsed['pmid'])
+            self.pending.remove(index)
+            retrieved += 1
+
+            for parsed in chunk_records:
+                records.append(parsed)
+                self.failed_pmids.discard(parsed['pmid'])
+
+        if not retrieved:
+            raise PubmedError('Nothing retrieved for given identifiers')
 
-        progress_bar.dismiss()
-        return self.records, sorted(list(self.failed_pmids))
+        return records, sorted(list(self.failed_pmids))
 
 
 if __name__ == '__main__':
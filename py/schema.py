@@ -0,0 +1,341 @@
+'''
+upgrade older database files to the current schema.
+
+Each upgrade is an SQL script with a version number. The version of a database
+file is kept in sqlite's user_version pragma, which is 0 for files created
+before any of this existed, including resources/default.sqlite. On opening the
+database, we apply whatever upgrades the file hasn't seen yet.
+'''
+from SqliteDB import OperationalError
+
+upgrades = []
+
+# branch_closure holds one row for every pair of a folder and any folder at or
+# below it, so that ancestry and subtree lookups become simple joins instead of
+# recursive queries. The triggers keep it in sync with branches; deletions are
+# taken care of by the cascading foreign keys.
+upgrades.append((1, '''
+    create table if not exists branch_closure (
+        ancestor_id             integer not null references branches,
+        descendant_id           integer not null references branches,
+        depth                   integer not null,
+        primary key (ancestor_id, descendant_id),
+        foreign key(ancestor_id)    references branches(branch_id) on delete cascade,
+        foreign key(descendant_id)  references branches(branch_id) on delete cascade
+    );
+
+    create index if not exists idx_branch_closure_descendant
+        on branch_closure(descendant_id, depth);
+
+    delete from branch_closure;
+
+    insert into branch_closure (ancestor_id, descendant_id, depth)
+        with recursive closure(a, d, depth)
+            as ( select branch_id, branch_id, 0 from branches
+                 union all select closure.a, branches.branch_id, closure.depth + 1
+                        from branches, closure
+                        where branches.parent_id = closure.d
+                )
+        select a, d, depth from closure;
+
+    create trigger if not exists branch_closure_insert after insert on branches
+    begin
+        insert into branch_closure (ancestor_id, descendant_id, depth)
+            values (new.branch_id, new.branch_id, 0);
+
+        insert into branch_closure (ancestor_id, descendant_id, depth)
+            select ancestor_id, new.branch_id, depth + 1
+            from branch_closure
+            where descendant_id = new.parent_id;
+    end;
+
+    create trigger if not exists branch_closure_move after update of parent_id on branches
+    when old.parent_id is not new.parent_id
+    begin
+        -- detach the subtree from its old ancestors ...
+        delete from branch_closure
+        where descendant_id in
+                (select descendant_id from branch_closure where ancestor_id = new.branch_id)
+        and ancestor_id not in
+                (select descendant_id from branch_closure where ancestor_id = new.branch_id);
+
+        -- ... and hook it up to the new ones
+        insert into branch_closure (ancestor_id, descendant_id, depth)
+            select above.ancestor_id, below.descendant_id, above.depth + below.depth + 1
+            from branch_closure as above, branch_closure as below
+            where above.descendant_id = new.parent_id
+            and below.ancestor_id = new.branch_id;
+    end;
+'''))
+
+# Every change to a reference stamps it with the next value of a database-wide
+# revision counter. Exports use the stamp to tell which records need formatting
+# again; bibtex_cache keeps the formatted output of each record along with the
+# revision and output format it was made for.
+_revision_stamp = '''
+        update db_revision set value = value + 1;
+        update refs set revision = (select value from db_revision) where ref_id = %s.ref_id;
+'''
+
+upgrades.append((2, '''
+    create table if not exists db_revision (
+        value                   integer not null
+    );
+
+    insert into db_revision (value) select 0 where not exists (select * from db_revision);
+
+    alter table refs add column revision integer not null default 0;
+
+    create trigger if not exists refs_revision_insert after insert on refs
+    begin %(new)s    end;
+
+    create trigger if not exists refs_revision_update
+        after update of reftype_id, bibtexkey, title, year on refs
+    begin %(new)s    end;
+
+    create trigger if not exists refs_revision_delete after delete on refs
+    begin
+        update db_revision set value = value + 1;
+    end;
+
+    create trigger if not exists optional_revision_insert after insert on optional
+    begin %(new)s    end;
+
+    create trigger if not exists optional_revision_update after update on optional
+    begin %(new)s %(old)s    end;
+
+    create trigger if not exists optional_revision_delete after delete on optional
+    begin %(old)s    end;
+
+    create trigger if not exists uniqid_revision_insert after insert on uniqid
+    begin %(new)s    end;
+
+    create trigger if not exists uniqid_revision_update after update on uniqid
+    begin %(new)s %(old)s    end;
+
+    create trigger if not exists uniqid_revision_delete after delete on uniqid
+    begin %(old)s    end;
+
+    create table if not exists bibtex_cache (
+        ref_id                  integer primary key references refs,
+        revision                integer not null,
+        format                  text not null,
+        content                 text not null,
+        foreign key(ref_id)     references refs(ref_id) on delete cascade
+    );
+
+    create table if not exists sync_state (
+        target                  text primary key,
+        digest                  text not null
+    );
+''' % dict(new=_revision_stamp % 'new', old=_revision_stamp % 'old')))
+
+# bibtexkey is compared case-insensitively by LIKE, so a prefix search can only
+# use an index with nocase collation. make_bibtex_key relies on this.
+upgrades.append((3, '''
+    create index if not exists idx_bibtexkey_nocase on refs(bibtexkey collate nocase);
+'''))
+
+# a restraint on one field used to go through every row with that field_id.
+# With content in the index, equality and prefix matches become lookups, and
+# with ref_id as well, the table itself is never touched. The old field_id
+# index is a prefix of the new one, so it can go.
+upgrades.append((4, '''
+    create index if not exists idx_optional_field_content on optional(field_id, content, ref_id);
+    create index if not exists idx_uniqid_field_content on uniqid(field_id, content, ref_id);
+    drop index if exists idx_optional_field_id;
+    analyze optional;
+    analyze uniqid;
+'''))
+
+# the index above copies every abstract, which makes it more than twice the
+# size of the table, and a substring match - which is what abstracts and
+# comments get searched with - can't use it anyway. It now leaves out these
+# long text fields. sqlite only uses a partial index if the query repeats its
+# condition, so search gets that from short_field_condition as well.
+long_text_fields = ['abstract', 'comment']
+
+def short_field_condition(field_ids, column='field_id'):
+    '''
+    the condition of the partial index on optional. field_ids maps field
+    names to ids.
+    '''
+    ids = sorted(field_ids[name] for name in long_text_fields)
+    return '%s not in (%s)' % (column, ', '.join(str(i) for i in ids))
+
+
+def _short_field_index(db):
+    field_ids = dict(db.execute('select name, field_id from fields', row_dicts=False).fetchall())
+
+    return '''
+    drop index if exists idx_optional_field_content;
+    create index idx_optional_field_content on optional(field_id, content, ref_id)
+        where %s;
+    analyze optional;
+''' % short_field_condition(field_ids)
+
+upgrades.append((5, _short_field_index))
+
+# search orders its restraints by how many rows and distinct values each field
+# has. Counting them takes a while on a large database, so they are kept here
+# rather than collected again at every start.
+upgrades.append((6, '''
+    create table if not exists search_stats (
+        field                   text primary key,
+        rows                    integer not null,
+        distinct_values         integer not null
+    );
+'''))
+
+
+def schema_version(db):
+    return db.execute('pragma user_version', row_dicts=False).fetchvalue()
+
+
+def upgrade(db):
+    '''
+    bring the database up to date. db is a SqliteDB instance. A script
+    may also be a function that makes it from the database.
+    '''
+    current = schema_version(db)
+
+    for version, script in upgrades:
+        if version <= current:
+            continue
+
+        if callable(script):
+            script = script(db)
+
+        db.commit()
+        db.executescript('begin; %s; pragma user_version = %d; commit;' % (script, version))
+
+
+# The full text index is not a numbered upgrade, because not every sqlite build
+# comes with fts5, and it is only wanted if [search] full_text is on. In that
+# case we set it up on every start if we can, and otherwise drop the triggers,
+# which would fail without the module. The index is rebuilt whenever the
+# triggers have to be created afresh, since it may have gone stale meanwhile.
+# With full_text off, the index and its triggers are removed altogether, so
+# that writes and the file size don't pay for a feature nobody uses.
+fts_fields = 'title author abstract journal keywords'.split()
+
+fts_optional = ", ".join("'%s'" % f for f in fts_fields[1:])
+
+# without the 'indexed by', sqlite may decide to go through all optional rows
+# with the wanted field_id, which makes every trigger invocation crawl.
+_fts_content = '''
+    select
+        refs.ref_id,
+        refs.title,
+        %s
+    from refs
+''' % ",\n        ".join('''(select group_concat(content, ' ')
+            from optional indexed by idx_optional_ref_id, fields
+            where optional.ref_id = refs.ref_id and optional.field_id = fields.field_id
+            and fields.name = '%s')''' % f for f in fts_fields[1:])
+
+_fts_refresh = '''
+        delete from ref_fts where rowid = %%(ref_id)s;
+        insert into ref_fts (rowid, %s)
+            %s
+            where refs.ref_id = %%(ref_id)s;
+''' % (', '.join(fts_fields), _fts_content)
+
+# trigger name -> (event, row whose index entry needs updating)
+_fts_triggers = dict(
+    refs_fts_insert = ('after insert on refs', 'new'),
+    refs_fts_update = ('after update of title on refs', 'new'),
+    refs_fts_delete = ('after delete on refs', 'old'),
+    optional_fts_insert = ('after insert on optional', 'new'),
+    optional_fts_update = ('after update on optional', 'new'),
+    optional_fts_delete = ('after delete on optional', 'old'),
+)
+
+def _fts_trigger_sql(name):
+    event, row = _fts_triggers[name]
+    when = ''
+
+    if name.startswith('optional'):
+        when = '''when %s.field_id in
+            (select field_id from fields where name in (%s))''' % (row, fts_optional)
+
+    # if the reference itself is gone, this just deletes the index entry
+    body = _fts_refresh % dict(ref_id='%s.ref_id' % row)
+    return 'create trigger %s %s %s\n    begin %s    end;' % (name, event, when, body)
+
+
+def fts_available(db):
+    '''
+    check if this sqlite build comes with fts5
+    '''
+    try:
+        db.execute('create virtual table temp.fts_probe using fts5(content)')
+        db.execute('drop table temp.fts_probe')
+        return True
+    except OperationalError:
+        return False
+
+
+def rebuild_fts(db):
+    '''
+    fill the full text index from scratch
+    '''
+    db.execute('delete from ref_fts')
+    db.execute('insert into ref_fts (rowid, %s) %s' % (', '.join(fts_fields), _fts_content))
+    db.commit()
+
+
+def _existing_fts_triggers(db):
+    stmt = "select name, sql from sqlite_master where type='trigger' and name in (%s)"
+    return dict(db.execute_qmarks(stmt, [_fts_triggers.keys()], row_dicts=False).fetchall())
+
+
+def drop_fts(db):
+    '''
+    remove the full text index and its triggers, if they are there. The
+    file is vacuumed afterwards to give back the space the index took.
+    '''
+    existing = _existing_fts_triggers(db)
+    stmt = "select count(*) from sqlite_master where type='table' and name='ref_fts'"
+    has_table = db.execute(stmt, row_dicts=False).fetchvalue()
+
+    for name in existing:
+        db.execute('drop trigger %s' % name)
+
+    # dropping a virtual table needs the module that made it
+    if has_table and fts_available(db):
+        db.execute('drop table ref_fts')
+        db.commit()
+        db.execute('vacuum')
+    else:
+        db.commit()
+
+
+def ensure_fts(db):
+    '''
+    set up or tear down the full text index and its triggers. Returns True
+    if the index is available.
+    '''
+    existing = _existing_fts_triggers(db)
+
+    if not fts_available(db):
+        for name in existing:
+            db.execute('drop trigger %s' % name)
+        db.commit()
+        return False
+
+    # triggers from an older version of this module are replaced
+    wanted = { name : _fts_trigger_sql(name) for name in _fts_triggers }
+
+    if all(existing.get(name) == sql.rstrip(';') for name, sql in wanted.items()):
+        return True
+
+    script = ['create virtual table if not exists ref_fts using fts5(%s);' % ', '.join(fts_fields)]
+    script += ['drop trigger if exists %s;' % name for name in _fts_triggers]
+    script += list(wanted.values())
+
+    db.commit()
+    db.executescript('begin; %s commit;' % '\n'.join(script))
+    rebuild_fts(db)
+
+    return True
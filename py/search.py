@@ -1,11 +1,12 @@
 '''
 
 '''
-import textwrap
+import os, textwrap
+from collections import OrderedDict
 from hub import hub, RefdbError, IntegrityError
-from utils import OrderedSet
 from string import ascii_letters
 from config import config
+from schema import fts_fields, long_text_fields, short_field_condition
 
 class Search(object):
 
@@ -24,10 +25,28 @@ class Search(object):
 
     bool_precedence = config['search']['bool_precedence']
     lazy_like = config['search'].getboolean('lazy_like')
+    use_full_text = config['search'].getboolean('full_text', False)
+
+    explain_log = config['search'].get('explain_log', '')
+
+    # the listings of recent searches; see search_references
+    cache_size = config['search'].getint('cache_size', 32)
 
     comparators = ">= <= > < =".split()
     placeholder = "_table_field_"
 
+    # rough guesses at the fraction of a field's values that a clause matches,
+    # used to decide which restraint the query should start from. Only their
+    # order matters; equality uses the number of distinct values instead.
+    substring_fraction = 0.25
+    prefix_fraction = 0.1
+    range_fraction = 0.33
+    full_text_fraction = 0.05
+
+    # the statistics are collected again once the number of references has
+    # changed by more than this fraction
+    stats_drift = 0.1
+
     def __init__(self):
         self._db = hub.sqlite
         self._saved_search = None
@@ -35,6 +54,12 @@ class Search(object):
         self.search_node = self.special_branch_nodes['Search']
         self.search_id = self.search_node[1]
 
+        # the full text index may be missing if sqlite was built without fts5
+        self.use_full_text = self.use_full_text and hub.coredb.full_text
+
+        self._stats = None              # (db revision, stats)
+        self._results = OrderedDict()   # (query, db revision) -> listing rows
+
     def saved_search(self):
         return self._saved_search
 
@@ -43,9 +68,9 @@ class Search(object):
         return getattr(hub.coredb, att)
 
 
-    def translate_restraint(self, clause):
+    def parse_restraint(self, clause):
         '''
-        translate a single clause, unencumbered by conjunctions and disjunctions
+        work out comparison operator and search term of a single clause
         '''
         for comp in self.comparators:
             if clause.startswith(comp):
@@ -63,39 +88,282 @@ class Search(object):
                     if not '%' in term:
                         term = '%{}%'.format(term)
                     comp = 'like'
+
+        return comp, term
+
+
+    def translate_restraint(self, clause):
+        '''
+        translate a single clause, unencumbered by conjunctions and disjunctions.
+        Returns the expression, with a placeholder for the term, and the term.
+        '''
+        comp, term = self.parse_restraint(clause)
+
         try:
             term = int(term)
-            expr = '{%s} %s %s' % (self.placeholder, comp, term)
         except ValueError:
-            expr = '{%s} %s "%s"' % (self.placeholder, comp, term.strip())
-        return expr
+            term = term.strip()
 
+        return '{%s} %s ?' % (self.placeholder, comp), term
 
-    def translate_restraints(self, table_field, raw):
+
+    def split_restraints(self, raw):
         '''
-        break up raw restraints across boolean operators and
-        translate each of the resulting fragments, then
-        glue everything back together again
+        break up raw restraints across boolean operators. Returns a list
+        of lists of clauses, and the words to join the inner and the outer
+        lists with.
         '''
-
         if self.bool_precedence == 'or':
             split_first, split_last, join_first, join_last = \
-                self.conjunction, self.disjunction, " or ", " and "
+                self.conjunction, self.disjunction, "or", "and"
         else:
             split_first, split_last, join_first, join_last = \
-                self.disjunction, self.conjunction, " and ", " or "
+                self.disjunction, self.conjunction, "and", "or"
+
+        groups = [cf.split(split_last) for cf in raw.split(split_first)]
+        groups = [[r.strip() for r in restraints] for restraints in groups]
+
+        return groups, join_first, join_last
+
+
+    def translate_restraints(self, table_field, raw):
+        '''
+        break up raw restraints across boolean operators and
+        translate each of the resulting fragments, then
+        glue everything back together again. Returns the sql
+        and the values for its placeholders.
+        '''
+        groups, join_first, join_last = self.split_restraints(raw)
+        ctrans, params = [], []
+
+        for restraints in groups:
+            translated = [ self.translate_restraint(r) for r in restraints ]
+            params.extend(term for expr, term in translated)
+
+            ctrans.append("(%s)" % (" %s " % join_first).join(expr for expr, term in translated) )
+
+        template = "(%s)" % (" %s " % join_last).join(ctrans)
+        return template.format(**{ self.placeholder : table_field }), params
+
+
+    def translate_fts_restraint(self, clause):
+        '''
+        translate a single clause into an fts5 query string. Each word matches
+        by prefix, unless the clause is quoted, in which case we look for the
+        exact phrase. Comparisons, explicit wild cards and numbers are beyond
+        the index, so we return None for those.
+        '''
+        term = clause.strip()
+
+        if '%' in term or [comp for comp in self.comparators if term.startswith(comp)]:
+            return None
+
+        try:
+            int(term)
+            return None
+        except ValueError:
+            pass
+
+        if len(term) > 1 and term.startswith('"') and term.endswith('"'):
+            phrase, prefix = term[1:-1], ''
+        elif term.endswith('*'):
+            phrase, prefix = term[:-1], '*'
+        elif self.lazy_like:
+            phrase, prefix = term, '*'
+        else:  # exact match of whole field requested
+            return None
+
+        if not phrase.strip():
+            return None
+
+        return '"%s"%s' % (phrase.replace('"', '""'), prefix)
+
 
-        cfrags = raw.split(split_first)
+    def translate_fts_restraints(self, field, raw):
+        '''
+        the full text counterpart of translate_restraints. If any fragment
+        can't be handled by the index, we return None, and the whole field
+        gets the conventional treatment.
+        '''
+        groups, join_first, join_last = self.split_restraints(raw)
         ctrans = []
 
-        for cf in cfrags:
-            restraints = cf.split(split_last)
-            translated = [ self.translate_restraint(r.strip()) for r in restraints ]
+        for restraints in groups:
+            translated = [ self.translate_fts_restraint(r) for r in restraints ]
+
+            if None in translated:
+                return None
+
+            ctrans.append("(%s)" % (" %s " % join_first.upper()).join(translated) )
+
+        query = (" %s " % join_last.upper()).join(ctrans)
+
+        return "select rowid as ref_id from ref_fts where %s match ?" % field, [query]
+
+
+    def search_stats(self):
+        '''
+        how many rows each field has, and how many distinct values, keyed
+        by field name. Collecting them takes a while on a large database, so
+        they are kept in the search_stats table, and only collected again
+        once the number of references has shifted noticeably; the numbers
+        just decide the order of restraints, so it doesn't matter if they
+        get a bit out of date.
+        '''
+        revision = self._db.execute('select value from db_revision', row_dicts=False).fetchvalue()
+
+        if self._stats is None:
+            stmt = 'select field, rows, distinct_values from search_stats'
+            rows = self._db.execute(stmt, row_dicts=False).fetchall()
+            self._stats = None, { field : (n, distinct) for field, n, distinct in rows }
+
+        stats_revision, stats = self._stats
+
+        if revision == stats_revision:
+            return stats
+
+        if 'title' in stats:
+            ref_count = stats['title'][0]
+            current = self._db.execute('select count(*) from refs', row_dicts=False).fetchvalue()
+
+            if abs(current - ref_count) <= self.stats_drift * ref_count:
+                self._stats = revision, stats
+                return stats
+
+        stats = self.collect_stats()
+
+        self._db.execute('delete from search_stats')
+        self._db.insert_rows('search_stats', ('field', 'rows', 'distinct_values'),
+                             [(field, n, distinct) for field, (n, distinct) in stats.items()])
+        self._db.commit()
+
+        self._stats = revision, stats
+        return stats
+
+
+    def collect_stats(self):
+        '''
+        count the rows and distinct values of each field
+        '''
+        field_names = { v:k for k, v in self.field_types.items() }
+        stats = {}
+
+        for table in ('optional', 'uniqid'):
+            stmt = 'select field_id, count(*), count(distinct content) from %s group by field_id' % table
+            for field_id, rows, distinct in self._db.execute(stmt, row_dicts=False).fetchall():
+                stats[field_names[field_id]] = (rows, distinct)
+
+        stmt = 'select count(*), count(distinct year), count(distinct reftype_id) from refs'
+        rows, years, reftypes = self._db.execute(stmt, row_dicts=False).fetchone()
 
-            ctrans.append("(%s)" % (join_first.join(translated) ) )
+        stats['bibtexkey'] = stats['title'] = (rows, rows)
+        stats['year'] = (rows, years)
+        stats['reftype'] = (rows, reftypes)
 
-        template = "(%s)" % join_last.join(ctrans)
-        return template.format(**{ self.placeholder : table_field })
+        return stats
+
+
+    def estimate_restraints(self, field, raw, full_text=False):
+        '''
+        guess how many references match the restraints on one field.
+        Clauses joined by 'and' can't match more than the most selective
+        one, and those joined by 'or' no more than all of them together.
+        '''
+        rows, distinct = self.search_stats().get(field, (0, 0))
+
+        if rows == 0:
+            return 0
+
+        def clause_estimate(clause):
+            if full_text:
+                return rows * self.full_text_fraction
+
+            comp, term = self.parse_restraint(clause)
+
+            if comp == '=':
+                return rows / max(distinct, 1)
+            if comp != 'like':
+                return rows * self.range_fraction
+            if term.startswith('%'):
+                return rows * self.substring_fraction
+            return rows * self.prefix_fraction
+
+        groups, join_first, join_last = self.split_restraints(raw)
+        combine = { 'and' : min, 'or' : sum }
+
+        estimates = [combine[join_first](clause_estimate(r) for r in restraints) for restraints in groups]
+
+        return min(rows, combine[join_last](estimates))
+
+
+    def plan_restraint(self, field, value):
+        '''
+        translate the restraints on one field. Returns the estimated number
+        of matches, a query for the matching ref_ids if there is one, and
+        a condition on the refs row. Query and condition each come as the
+        sql and the values for its placeholders.
+        '''
+        if self.use_full_text and field in fts_fields:
+            ids = self.translate_fts_restraints(field, value)
+
+            if ids is not None:
+                estimate = self.estimate_restraints(field, value, full_text=True)
+                sql, params = ids
+                return estimate, ids, ('(refs.ref_id in (%s))' % sql, params)
+
+        estimate = self.estimate_restraints(field, value)
+
+        if field in ("bibtexkey", "title", "year"):
+            return estimate, None, self.translate_restraints("refs.%s" % field, value)
+
+        if field == 'reftype':
+            sql, params = self.translate_restraints('reftypes.name', value)
+            condition = '(refs.reftype_id in (select reftype_id from reftypes where %s))' % sql
+            return estimate, None, (condition, params)
+
+        table = 'uniqid' if field in ("doi", "pmid") else 'optional'
+        field_id = self.field_types[field]
+
+        # long text fields are left out of the content index on optional. For
+        # the others, the index only gets used if we repeat its condition.
+        content_index = field not in long_text_fields
+        partial = table == 'optional'
+
+        def field_terms(column):
+            terms = '%s = %s' % (column, field_id)
+            if partial:
+                terms += ' and %s' % short_field_condition(self.field_types, column)
+            return terms
+
+        sql, params = self.translate_restraints('content', value)
+
+        if content_index:
+            ids = 'select ref_id from %s indexed by idx_%s_field_content where %s and %s' \
+                      % (table, table, field_terms('field_id'), sql)
+        else:
+            ids = 'select ref_id from %s where field_id = %s and %s' % (table, field_id, sql)
+
+        # checking a single reference for exact values is a lookup in the same
+        # index. Otherwise, we want the rows of the reference; left to itself,
+        # sqlite may instead go through all rows with the field_id.
+        groups = self.split_restraints(value)[0]
+        alias = 'f_%s' % field
+
+        if content_index and all(self.parse_restraint(r)[0] == '=' for restraints in groups for r in restraints):
+            index = 'idx_%s_field_content' % table
+            terms = field_terms('%s.field_id' % alias)
+        else:
+            index = 'idx_%s_ref_id' % table
+            terms = '%s.field_id = %s' % (alias, field_id)
+
+        # an alias named after the field keeps the sql the same for searches
+        # of the same shape, so that sqlite can reuse the prepared statement
+        sql, params = self.translate_restraints('%s.content' % alias, value)
+        condition = 'exists (select 1 from %s as %s indexed by %s ' \
+                    'where %s.ref_id = refs.ref_id and %s and %s)' \
+                        % (table, alias, index, alias, terms, sql)
+
+        return estimate, (ids, params), (condition, params)
 
 
     def build_sql(self, data):
@@ -109,36 +377,22 @@ class Search(object):
         actually there IS a difference, so we will use 'like' only if there
         is a '%' in the search value.
 
-        So that will make things a lot more straightforward.
-        '''
-        from_tables = OrderedSet(["refs"])
-        restraints = OrderedSet()
-        alias_counter = 0
-
-        for field, value in list(data.items()):
-            if not value:
-                continue
-
-            if field in ("bibtexkey", "title", "year"):
-                key = "refs.%s" % field
-                restraints.add(self.translate_restraints(key, value))
-                continue
-
-            if field == 'reftype':
-                from_tables.add('reftypes')
-                restraints.add('(reftypes.reftype_id = refs.reftype_id)')
-                restraints.add(self.translate_restraints('reftypes.name', value))
-                continue
+        The restraints are ordered by how many references they are likely
+        to match. If the most selective one has a query for ref_ids of its
+        own, the search starts from that - the cross join keeps sqlite from
+        reordering - and everything else is only checked for the references
+        it finds.
 
-            table = 'uniqid' if field in ("doi", "pmid") else 'optional'
-            alias_counter += 1
-            alias = "%s%s" % (table[:3], alias_counter)
+        The search terms are passed as parameters, so we return them along
+        with the sql.
+        '''
+        plan = []
 
-            from_tables.add('%s as %s' % (table, alias))
+        for field, value in data.items():
+            if value:
+                plan.append(self.plan_restraint(field, value))
 
-            restraints.add('(%s.ref_id = refs.ref_id)' % alias)
-            restraints.add('(%s.field_id = %s)' % (alias, self.field_types[field]))
-            restraints.add(self.translate_restraints('%s.content' % alias, value))
+        plan.sort(key=lambda restraint: restraint[0])   # stable, so ties keep their order
 
         # format the sql
         start_clause = """
@@ -148,24 +402,77 @@ class Search(object):
 
         line = '    %s\n'
 
-
         sql = textwrap.dedent(start_clause) + '\n'
+        params = []
 
-        for i, clause in enumerate(from_tables):
-            if i+1 < len(from_tables):
-                clause += ','
-            sql += line % clause
-
-        sql += 'where\n'
+        if plan and plan[0][1] is not None:
+            estimate, (ids, ids_params), condition = plan.pop(0)
+            sql += line % ('(%s) as hits' % ids)
+            sql += line % 'cross join refs on refs.ref_id = hits.ref_id'
+            params.extend(ids_params)
+        else:
+            sql += line % 'refs'
 
-        for i, r in enumerate(restraints):
-            if i > 0:
-                r = 'and ' + r
-            sql += line % r
+        for i, (estimate, ids, (condition, condition_params)) in enumerate(plan):
+            if i == 0:
+                sql += 'where\n'
+            else:
+                condition = 'and ' + condition
+            sql += line % condition
+            params.extend(condition_params)
 
         # open('/home/mpalmer/sql.log','w').write(sql)
 
-        return sql.lstrip()
+        return sql.lstrip(), params
+
+
+    def explain(self, sql, params=()):
+        '''
+        sqlite's query plan for sql, as indented lines of text
+        '''
+        rows = self._db.execute('explain query plan ' + sql, params, row_dicts=False).fetchall()
+        depth, lines = {0: -1}, []
+
+        for node_id, parent_id, unused, detail in rows:
+            depth[node_id] = depth.get(parent_id, -1) + 1
+            lines.append('  ' * depth[node_id] + detail)
+
+        return lines
+
+
+    def normalize_query(self, data):
+        '''
+        the restraints that matter for a search, in a hashable form that
+        doesn't depend on the order of fields or on surrounding white space
+        '''
+        return tuple(sorted((field, value.strip()) for field, value in data.items() \
+                                if value and value.strip()))
+
+
+    def cached_results(self, query, revision):
+        '''
+        the Search folder listing of an earlier search with the same query,
+        or None. Whenever a reference changes, the triggers bump db_revision,
+        so results found before then don't come back. Fresh results are never
+        selected, so the rows stay valid as well.
+        '''
+        key = (query, revision)
+        refs = self._results.get(key, None)
+
+        if refs is not None:
+            self._results.move_to_end(key)
+
+        return refs
+
+
+    def cache_results(self, query, revision, refs):
+        if self.cache_size <= 0:
+            return
+
+        self._results[(query, revision)] = refs
+
+        while len(self._results) > self.cache_size:
+            self._results.popitem(last=False)
 
 
     def search_references(self, data):
@@ -174,18 +481,59 @@ class Search(object):
         we also save the input for later editing.
         '''
         self._saved_search = data.copy()
-        sql = self.build_sql(data)
-        results = self._db.execute(sql).fetchvalues()
 
-        # clear out previous search results
+        query = self.normalize_query(data)
+        revision = self._db.execute('select value from db_revision', row_dicts=False).fetchvalue()
+        refs = self.cached_results(query, revision)
+
+        # clear out previous search results. References that were only
+        # in there end up in the trash.
+        trash_id = self.special_branch_names['Trash']
+        self.invalidate_branches([self.search_id, trash_id])
         self._db.execute('delete from reflink where branch_id=(?)', [self.search_id])
 
-        for ref_id in results:
-            self._db.insert('reflink', dict(ref_id=ref_id, branch_id=self.search_id))
+        if refs is not None:
+            ref_ids = sorted(r['ref_id'] for r in refs)     # in index order, which inserts faster
+            self._db.insert_rows('reflink', ('ref_id', 'branch_id'),
+                                 [(ref_id, self.search_id) for ref_id in ref_ids])
+        else:
+            sql, params = self.build_sql(data)
+
+            if self.explain_log:
+                with open(os.path.expanduser(self.explain_log), 'a') as log:
+                    log.write('%s%s\n%s\n\n' % (sql, params, '\n'.join(self.explain(sql, params))))
+
+            # the results go straight from the query into reflink, without
+            # a round trip through python
+            stmt = 'insert into reflink (ref_id, branch_id) select distinct ref_id, (?) from (%s)' % sql
+            self._db.execute(stmt, [self.search_id] + params)
+
+            # and we list the folder from what we just wrote, rather than
+            # leaving it to the tree to query again
+            stmt = """
+                   select
+                       refs.ref_id,
+                       refs.bibtexkey,
+                       refs.title,
+                       refs.year,
+                       reflink.branch_id as parent_id,
+                       reflink.selected
+                   from reflink
+                   join refs on refs.ref_id = reflink.ref_id
+                   where reflink.branch_id = (?)
+                   """
+            refs = self._db.execute(stmt, [self.search_id], row_dicts=self._db.ROWS).fetchall()
+            self.cache_results(query, revision, refs)
 
         self._db.commit()
-        hub.refresh_tree_item(self.search_node)
-        hub.goto_search()
+
+        record = self.get_branch_record(self.search_id)
+
+        if self._belongs_to_matching_folder(record, include_children=False):
+            self.store_child_references(self.search_node, list(refs))   # it sorts in place
+
+        hub.refresh_tree()
+        hub.focus_node(self.search_node)
 
 
     def reset_search(self):
@@ -195,9 +543,11 @@ class Search(object):
         self._db.execute('delete from reflink where branch_id=(?)', [self.search_id])
         self._db.commit()
 
-        hub.clear_cache()   # needed to flush out the zombies
-        hub.tree.refresh()  # it is possible that stuff was ONLY in search, so we need
-                            # to make sure Trash is updated
+        # flush out the zombies. it is possible that stuff was ONLY in search,
+        # so we need to make sure Trash is updated as well.
+        trash_id = self.special_branch_names['Trash']
+        self.invalidate_branches([self.search_id, trash_id])
+        hub.refresh_tree()
 
 
 _export = '''
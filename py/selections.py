@@ -35,7 +35,7 @@ class Selections(object):
         with having the selected attribute on the reference?
         '''
         if node is None:    # invocation from menu will trigger this case
-            node = hub.tree.focus_element()
+            node = hub.current_node()
 
         node_type, node_id, parent_id = node
         is_branch = node_type == hub.BRANCH
@@ -58,31 +58,24 @@ class Selections(object):
 
             if currently_selected == 0:   # going to be 1 - deselect all individually selected
                                           # descendants. Is that sensible? Let's try it out.
-                # deselect references.
+                # deselect references, including those in the folder itself.
                 stmt = '''
-                with recursive branch_set( i )
-                    as ( select branch_id from branches where parent_id = (?)
-                         union select branch_id from branches, branch_set
-                                where branches.parent_id = branch_set.i
-                        )
                     update reflink
                     set selected = 0
                     where selected = 1
-                    and branch_id in branch_set or branch_id = (?);
+                    and branch_id in
+                        ( select descendant_id from branch_closure where ancestor_id = (?) )
                 '''
-                self._db.execute(stmt, [node_id, node_id])
+                self._db.execute(stmt, [node_id])
 
                 # deselect branches
                 stmt = '''
-                with recursive branch_set( i )
-                    as ( select branch_id from branches where parent_id = (?)
-                         union select branch_id from branches, branch_set
-                                where branches.parent_id = branch_set.i
-                        )
                     update branches
                     set selected = 0
                     where selected = 1
-                    and branch_id in branch_set;
+                    and branch_id in
+                        ( select descendant_id from branch_closure
+                          where ancestor_id = (?) and depth > 0 )
                 '''
                 self._db.execute(stmt, [node_id])
 
@@ -101,8 +94,11 @@ class Selections(object):
 
         self._db.commit()
 
-        hub.clear_cache()
-        hub.tree.refresh()
+        if is_branch:
+            self.invalidate_branches([node_id], recursive=True)
+        else:
+            self.invalidate_nodes([node])
+        hub.refresh_tree()
 
 
     def add_folder(self, parent, new_name):
@@ -129,16 +125,16 @@ class Selections(object):
         new_id = c.lastrowid
         self._db.commit()
 
-        # clearing the cache shouldn't be needed, but it is - deleted folder nodes
-        # somehow linger, and if an id gets reused, the zombies reappear
-        hub.clear_cache()
-        hub.tree.refresh()
+        # deleted folder nodes may linger in the cache, and if an id gets reused,
+        # the zombies reappear - so we also flush out anything under the new id
+        self.invalidate_branches([parent_id, new_id])
+        hub.refresh_tree()
 
         # now, we should be able to construct the new node signature without going
         # back to the database
         new_node = (hub.BRANCH, new_id, parent_id)
-        hub.tree.set_focus(new_node)
-        hub.tree.add_to_history(new_node)
+        hub.focus_node(new_node)
+        hub.add_to_history(new_node)
 
 
     def move_selected(self, node=None):
@@ -146,11 +142,25 @@ class Selections(object):
         move selected items into current folder. Reset selected to 0.
         '''
         if node is None:    # invocation from menu will trigger this case
-            node = hub.tree.focus_element()
+            node = hub.current_node()
 
         assert hub.is_branch(node)
         node_id = node[1]
 
+        # a folder can't be moved underneath itself
+        stmt = '''
+               select count(*) from branch_closure, branches
+               where branches.selected = 1
+               and branch_closure.ancestor_id = branches.branch_id
+               and branch_closure.descendant_id = (?)
+               '''
+        if self._db.execute(stmt, [node_id]).fetchvalue():
+            hub.show_errors("can't move folder underneath itself")
+            return
+
+        # remember where things used to be, for cache invalidation
+        branches, reflinks = self._selected_items()
+
         # get hold of all selected folders
         stmt = 'update branches set parent_id=(?), selected=0 where selected=1'
         c = self._db.execute(stmt, [node_id])
@@ -174,8 +184,37 @@ class Selections(object):
             hub.show_errors('Nothing was moved')
         else:
             self._db.commit()
-            hub.clear_cache()
-            hub.tree.refresh()
+            self._invalidate_selected(branches, reflinks, [node_id])
+            hub.refresh_tree()
+
+
+    def _selected_items(self):
+        '''
+        collect selected folders and references before they get modified,
+        so that we know afterwards which parts of the cache to invalidate.
+        '''
+        stmt = 'select branch_id, parent_id from branches where selected=1'
+        branches = self._db.execute(stmt, row_dicts=False).fetchall()
+
+        stmt = 'select ref_id, branch_id from reflink where selected=1'
+        reflinks = self._db.execute(stmt, row_dicts=False).fetchall()
+
+        return branches, reflinks
+
+
+    def _invalidate_selected(self, branches, reflinks, extra_branch_ids=()):
+        '''
+        invalidate the cache for the items collected by _selected_items,
+        and for the folders that contained them.
+        '''
+        parent_ids = set(extra_branch_ids)
+        parent_ids.update(b[1] for b in branches)
+        parent_ids.update(r[1] for r in reflinks)
+
+        self.invalidate_branches([b[0] for b in branches], recursive=True)
+        self.invalidate_branches(parent_ids)
+        self.invalidate_refs(set(r[0] for r in reflinks))
+
 
     def count_selected_items(self):
         b = self._db.execute('select count(*) from branches where selected=1').fetchvalue()
@@ -191,7 +230,7 @@ class Selections(object):
         might just call that at the end.
         '''
         if node is None:    # invocation from menu will trigger this case
-            node = hub.tree.focus_element()
+            node = hub.current_node()
 
         assert hub.is_branch(node)
         node_id = node[1]
@@ -218,17 +257,18 @@ class Selections(object):
 
         failed_refs = 0
 
-        for ref_id in ref_ids:
-            try:
-                self._db.insert('reflink', dict(ref_id=ref_id, branch_id=node_id))
-                success += 1
-            except IntegrityError:
-                failed_refs += 1
+        # references already in the target folder are skipped by the unique
+        # constraint on reflink, so we count them from what went in.
+        c = self._db.insert_or_ignore('reflink', ('ref_id', 'branch_id'),
+                                      [(ref_id, node_id) for ref_id in ref_ids])
+        if c is not None:
+            success += c.rowcount
+            failed_refs = len(ref_ids) - c.rowcount
 
         if success:
             self._db.commit()
-            hub.clear_cache()
-            hub.tree.refresh()
+            self.invalidate_branches([node_id], recursive=True)
+            hub.refresh_tree()
 
         if failed_refs:
             suffix = '' if failed_refs==1 else 's'
@@ -267,14 +307,18 @@ class Selections(object):
         stmt = "select name,branch_id from branches where branch_id = (?)"
         old_data = self._db.execute(stmt, [branch_id]).fetchone()
 
-        return self._clone_branch(old_data, new_parent_id)
+        reflinks = []
+        new_branch_id = self._clone_branch(old_data, new_parent_id, reflinks)
+        self._db.insert_rows('reflink', ('ref_id', 'branch_id'), reflinks)
+
+        return new_branch_id
 
 
-    def _clone_branch(self, old_data, new_parent_id):
+    def _clone_branch(self, old_data, new_parent_id, reflinks):
         '''
         - create a new branch with old name and new parent_id
-        - for all references within orig, create copies in reflink
-          that point to new branch
+        - for all references within orig, collect (ref_id, new branch id)
+          pairs in reflinks; the caller inserts them all in one go
         - collect cloned_ids for all directories within orig by invoking
           _clone_branch recursively
         - append each of these to new branch
@@ -288,16 +332,14 @@ class Selections(object):
         old_branch_id = old_data['branch_id']
 
         stmt = 'select ref_id from reflink where branch_id=(?)'
-        ref_ids = self._db.execute(stmt, [old_branch_id]).fetchvalues()
-
-        for ref_id in ref_ids:
-            self._db.insert('reflink', dict(ref_id=ref_id, branch_id=new_branch_id))
+        ref_ids = self._db.execute(stmt, [old_branch_id], row_dicts=False).fetchvalues()
+        reflinks.extend((ref_id, new_branch_id) for ref_id in ref_ids)
 
         stmt = "select name, branch_id from branches where parent_id=(?)"
         folders = self._db.execute(stmt, [old_branch_id]).fetchall()
 
         for folder in folders:
-            self._clone_branch(folder, new_branch_id)
+            self._clone_branch(folder, new_branch_id, reflinks)
 
         return new_branch_id
 
@@ -307,7 +349,7 @@ class Selections(object):
         select references immediately in this folder, but not sub-folders
         '''
         if node is None:    # invocation from menu will trigger this case
-            node = hub.tree.focus_element()
+            node = hub.current_node()
 
         assert hub.is_branch(node)
         node_id = node[1]
@@ -317,8 +359,8 @@ class Selections(object):
 
         if c.rowcount != 0:
             self._db.commit()
-            hub.clear_cache()
-            hub.tree.refresh()
+            self.invalidate_branches([node_id])
+            hub.refresh_tree()
 
 
     """
@@ -335,7 +377,7 @@ class Selections(object):
         Flattening is now implemented in core_db, and this method has been retired.
         '''
         if node is None:    # invocation from menu will trigger this case
-            node = hub.tree.focus_element()
+            node = hub.current_node()
 
         assert hub.is_branch(node)
         node_id = node[1]
@@ -356,14 +398,26 @@ class Selections(object):
         if c.rowcount != 0: # why the hell does rowcount not respond? It is -1 - go figure. Is that because of recursion?
             self._db.commit()
             hub.clear_cache()
-            hub.tree.refresh()
+            hub.refresh_tree()
 
     """
 
-    def _update_or_delete_selected(self, stmt):
+    def _update_or_delete_selected(self, stmt, deleting=False):
         '''
         shared backend for simple operations on all selected items
         '''
+        branches, reflinks = self._selected_items()
+        branch_ids = [b[0] for b in branches]
+
+        # deleting folders takes their content along, so we need to
+        # know beforehand what is in there.
+        below, ref_ids = [], []
+
+        if deleting:
+            if branch_ids:
+                below, ref_ids = self.get_nodes_below(branch_ids, ids_only=True)
+            below.append(self.special_branch_names['Trash'])
+
         affected = 0
 
         for table in ("reflink", "branches"):
@@ -372,8 +426,9 @@ class Selections(object):
 
         if affected:
             self._db.commit()
-            hub.clear_cache()
-            hub.tree.refresh()
+            self._invalidate_selected(branches, reflinks, below)
+            self.invalidate_refs(ref_ids)
+            hub.refresh_tree()
 
 
     def deselect_all(self):
@@ -387,7 +442,7 @@ class Selections(object):
         '''
         delete all selected folders and references
         '''
-        self._update_or_delete_selected('delete from %s where selected=1')
+        self._update_or_delete_selected('delete from %s where selected=1', deleting=True)
 
 
     def get_selected_refs(self):
@@ -399,14 +454,12 @@ class Selections(object):
         This does mean, however, that ref_ids might be duplicates.
         '''
         stmt =  '''
-                with recursive branch_set( i )
-                    as (
-                        select branch_id from branches where selected = 1
-                        union select branch_id from branches, branch_set
-                                where branches.parent_id = branch_set.i
-                    )
-                    select ref_id, branch_id from reflink
-                    where branch_id in branch_set or selected=1
+                select ref_id, branch_id from reflink
+                where branch_id in
+                    ( select descendant_id from branch_closure, branches
+                      where branches.selected = 1
+                      and branch_closure.ancestor_id = branches.branch_id )
+                or selected=1
                 '''
         return self._db.execute(stmt, row_dicts=False).fetchall()
 
@@ -528,7 +581,7 @@ class Selections(object):
         mail currently highlighted reference
         '''
         if node is None:    # invocation from menu will trigger this case
-            node = hub.tree.focus_element()
+            node = hub.current_node()
 
         assert hub.is_ref(node)
         self._mail_references([node[1]])
@@ -50,7 +50,7 @@ class Trashcan(object):
         folders_before = self.item_count('branches')
 
         if node is None:    # invocation from menu will trigger this case
-            node = hub.tree.focus_element()
+            node = hub.current_node()
 
         parent = self.get_parent_node(node)
 
@@ -61,20 +61,28 @@ class Trashcan(object):
                 hub.show_errors('This folder is protected')
                 return
 
+            # collect everything underneath before it cascades away
+            branch_ids, ref_ids = self.get_nodes_below([node_id], ids_only=True)
+            branch_ids.append(node_id)
+
             stmt = "delete from branches where branch_id=(?)"
             values = [node_id]
         else:
+            branch_ids, ref_ids = [], [node_id]
+
             stmt = "delete from reflink where ref_id=(?) and branch_id=(?)"
             values = [node_id, parent_id]
 
         self._db.execute(stmt, values)
         self._db.commit()
 
-        hub.tree.set_focus(parent)
-        hub.tree.add_to_history(parent) # does this make sense? I suppose so.
+        self.invalidate_branches(branch_ids + [parent_id, self.trash_node[1]])
+        self.invalidate_refs(ref_ids)
 
-        hub.coredb.clear_cache()
-        hub.tree.refresh()
+        hub.focus_node(parent)
+        hub.add_to_history(parent) # does this make sense? I suppose so.
+
+        hub.refresh_tree()
 
         rdel = refs_before - self.item_count('reflink')
         fdel = folders_before - self.item_count('branches')
@@ -106,14 +114,18 @@ class Trashcan(object):
         delete any duplicates of a reference. This should be the common
         backend for single references, folders, and selections.
         '''
+        stmt = 'select distinct branch_id from reflink where ref_id in (%s) and branch_id not in (%s)'
+        affected_ids = self._db.execute_qmarks(stmt, [ref_ids, branch_ids]).fetchvalues()
+
         stmt = 'delete from reflink where ref_id in (%s) and branch_id not in (%s)'
 
         c = self._db.execute_qmarks(stmt, [ref_ids, branch_ids])
 
         if c.rowcount > 0:
             self._db.commit()
-            self.clear_cache()
-            hub.tree.refresh()
+            self.invalidate_branches(affected_ids)
+            self.invalidate_refs(ref_ids)
+            hub.refresh_tree()
 
 
     def delete_other_instances(self, node):
@@ -145,7 +157,7 @@ class Trashcan(object):
         and let it propagate to reflink etc. Yes, it works from the command line.
         '''
         if node is None:    # invocation from menu will trigger this case
-            node = hub.tree.focus_element()
+            node = hub.current_node()
 
         node_type, node_id, parent_id = node
         parent = self.get_parent_node(node)
@@ -158,16 +170,21 @@ class Trashcan(object):
         #Well, why take this aggressive approach? Why not just leave it in the trashcan?
         #Let's do that instead.
 
+        stmt = "select branch_id from reflink where ref_id=(?)"
+        branch_ids = self._db.execute(stmt, [node_id]).fetchvalues()
+
         stmt = "delete from reflink where ref_id=(?)"
 
         self._db.execute(stmt, [node_id])
         self._db.commit()
 
-        hub.tree.set_focus(parent)
-        hub.tree.add_to_history(parent) # does this make sense? I suppose so.
+        self.invalidate_branches(branch_ids + [self.trash_node[1]])
+        self.invalidate_refs([node_id])
+
+        hub.focus_node(parent)
+        hub.add_to_history(parent) # does this make sense? I suppose so.
 
-        hub.coredb.clear_cache()
-        hub.tree.refresh()
+        hub.refresh_tree()
 
         hub.set_status_bar('Moved one reference to trash')
 
@@ -185,12 +202,13 @@ class Trashcan(object):
         if not len(ref_ids):
             return
 
-        for ref_id in ref_ids:
-            self._db.insert('reflink', dict(ref_id=ref_id, branch_id=recycled_id))
+        self._db.insert_rows('reflink', ('ref_id', 'branch_id'),
+                             [(ref_id, recycled_id) for ref_id in ref_ids])
 
         self._db.commit()
-        hub.clear_cache()
-        hub.tree.refresh()
+        self.invalidate_branches([recycled_id, self.trash_node[1]])
+        self.invalidate_refs(ref_ids)
+        hub.refresh_tree()
 
         refs_recycled = self.item_count('reflink') - refs_before
         refs_suffix = '' if refs_recycled == 1 else 's'
@@ -204,6 +222,9 @@ class Trashcan(object):
         '''
         refs_before = self.item_count('reflink')
 
+        stmt = "select ref_id from reflink where branch_id = (?)"
+        ref_ids = self._db.execute(stmt, [folder_id]).fetchvalues()
+
         stmt = "delete from reflink where branch_id = (?)"
         c = self._db.execute(stmt, [folder_id])
         deleted = c.rowcount
@@ -213,8 +234,9 @@ class Trashcan(object):
 
         self._db.commit()
 
-        hub.clear_cache()
-        hub.tree.refresh()
+        self.invalidate_branches([folder_id, self.trash_node[1]])
+        self.invalidate_refs(ref_ids)
+        hub.refresh_tree()
 
         refs_deleted = refs_before - self.item_count('reflink')
 
@@ -1,5 +1,6 @@
-import subprocess, urllib.parse, collections, re, os, time
+import subprocess, urllib.parse, collections, re, os, shutil, time, threading
 from weakref import proxy
+from bisect import bisect_left, bisect_right
 from config import config
 
 _brace_re = re.compile(r'(?<=[^\\])[\{\}]')
@@ -100,6 +101,75 @@ class OrderedSet(collections.MutableSet):
         return not self.isdisjoint(other)
 
 
+class SortedKeys(object):
+    '''
+    a sorted list of strings. Membership tests and prefix lookups are
+    binary searches, and adding a key keeps the list sorted.
+    '''
+    def __init__(self, keys=()):
+        self.keys = sorted(set(keys))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        i = bisect_left(self.keys, key)
+        return i < len(self.keys) and self.keys[i] == key
+
+    def add(self, key):
+        i = bisect_left(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            self.keys.insert(i, key)
+
+    def with_prefix(self, prefix):
+        '''
+        all keys that start with prefix
+        '''
+        start = bisect_left(self.keys, prefix)
+        end = bisect_left(self.keys, prefix + chr(0x10ffff), start)
+        return self.keys[start:end]
+
+
+class PrefixIndex(object):
+    '''
+    find items in a list by the beginning of their keys, ignoring case.
+    Lookups are binary searches: single letters go through a sorted list
+    of positions per first letter, longer prefixes through the sorted keys.
+    '''
+    def __init__(self, keys):
+        self.entries = sorted((key.lower(), i) for i, key in enumerate(keys))
+        self.keys = [key for key, i in self.entries]
+        self.letters = collections.defaultdict(list)
+
+        for i, key in enumerate(keys):
+            self.letters[key[:1].lower()].append(i)
+
+    def next_match(self, prefix, after):
+        '''
+        position of the first item after position 'after' whose key starts
+        with prefix, wrapping around at the end, or None if there is none
+        '''
+        prefix = prefix.lower()
+
+        if len(prefix) == 1:
+            positions = self.letters.get(prefix, None)
+
+            if not positions:
+                return None
+
+            return positions[bisect_right(positions, after) % len(positions)]
+
+        start = bisect_left(self.keys, prefix)
+        end = bisect_left(self.keys, prefix + chr(0x10ffff), start)
+        positions = [i for key, i in self.entries[start:end]]
+
+        if not positions:
+            return None
+
+        later = [i for i in positions if i > after]
+        return min(later or positions)
+
+
 def locate(fn, case_sensitive=False, as_regex=True):
     '''
     use 'locate' to find a file
@@ -186,17 +256,104 @@ def writefile(file_name, text):
 
     All other file names and paths are interpreted relative to the user's
     home directory. Howabout using makedirs?
+
+    text may also be an iterable of strings, which then get written one
+    after the other. We write to a temporary file first, so that a failure
+    halfway through doesn't leave a truncated file behind. If file_name is a
+    symlink, the file it points to is replaced, and keeps its permissions.
     '''
+    if isinstance(text, str):
+        text = [text]
+
     if not file_name:
         rv = 'clipboard'
-        xsel(text)
+        xsel(''.join(text))
     else:
-        open(file_name,'w').write(text)
+        target = os.path.realpath(file_name)
+        tmp_name = target + '.part'
+
+        try:
+            with open(tmp_name, 'w') as outfile:
+                outfile.writelines(text)
+
+            if os.path.exists(target):
+                shutil.copymode(target, tmp_name)
+
+            os.replace(tmp_name, target)
+        finally:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+
         rv = file_name.replace(os.path.expanduser('~'), '~')
 
     return rv
 
 
+def with_retries(func, retries=2, backoff=1.0, give_up=None):
+    '''
+    call func until it succeeds, at most retries+1 times, and wait backoff,
+    2*backoff, 4*backoff ... seconds in between. If give_up(error) is true,
+    the error is raised right away - no point in asking again for something
+    that isn't there.
+    '''
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except Exception as error:
+            if attempt == retries or (give_up is not None and give_up(error)):
+                raise
+        time.sleep(backoff * 2 ** attempt)
+
+
+class RateLimiter(object):
+    '''
+    space out calls from any number of threads to at most rate per second.
+    Each caller reserves the next free slot and then sleeps until it comes up.
+    '''
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.lock = threading.Lock()
+        self.next_slot = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+
+        time.sleep(slot - now)
+
+
+def map_concurrently(func, items, threads=4, progress_bar=None):
+    '''
+    apply func to each item in a pool of threads. Returns a list of
+    (item, result, error) tuples in the order of items; error is None
+    on success.
+
+    The progress bar is updated from the calling thread only, since
+    urwid isn't thread-safe.
+    '''
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    items = list(items)
+    results = [None] * len(items)
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        futures = { pool.submit(func, item) : i for i, item in enumerate(items) }
+
+        for done, future in enumerate(as_completed(futures)):
+            i = futures[future]
+            try:
+                results[i] = (items[i], future.result(), None)
+            except Exception as error:
+                results[i] = (items[i], None, error)
+
+            if progress_bar is not None:
+                progress_bar.update(done+1)
+
+    return results
+
+
 class Null(object):
     '''
     An object that doesn't complain about anything we ask of it.